@@ -0,0 +1,73 @@
+"""
+Load test of Workflow.cast_vote_async: votes per second and latency
+percentiles at increasing concurrency.
+
+    python benchmarks/bench_cast_vote.py [votes] [storage]
+
+storage is folder (default) or sqlite
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import tempfile
+import concurrent.futures
+
+from human_security import HumanRSA
+
+from evote_ranking import Workflow
+from evote_ranking.storage import SQLiteStorage
+
+
+def make_workflow(folder, storage, votes):
+    h1 = HumanRSA()
+    h1.generate()
+    h2 = HumanRSA()
+    h2.generate()
+    if storage == 'sqlite':
+        storage = SQLiteStorage(os.path.join(folder, 'election.db'))
+    else:
+        storage = None
+    workflow = Workflow(folder, h1.public_pem(), h2.private_pem(), storage=storage)
+    workflow.setup()
+    workflow.register_candidates(['Tim', 'John', 'Matt', 'Anna'])
+    workflow.register_voters('voter-%i' % k for k in range(votes))
+    workflow.create_ballots(votes)
+    return workflow
+
+
+async def run(workflow, voter_ids, concurrency, executor):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    async def vote(voter_id):
+        async with semaphore:
+            preference = random.sample(workflow.candidates, len(workflow.candidates))
+            t0 = time.perf_counter()
+            await workflow.cast_vote_async(voter_id, preference, executor)
+            latencies.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    await asyncio.gather(*[vote(voter_id) for voter_id in voter_ids])
+    return time.perf_counter() - t0, sorted(latencies)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(votes=500, storage='folder'):
+    levels = (1, 4, 16, 64)
+    print('%12s %10s %10s %10s %10s' % ('concurrency', 'votes/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for concurrency in levels:
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_workflow(folder, storage, votes)
+            voter_ids = ['voter-%i' % k for k in range(votes)]
+            with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+                dt, latencies = asyncio.run(run(workflow, voter_ids, concurrency, executor))
+            print('%12i %10.1f %10.2f %10.2f %10.2f' % (
+                concurrency, votes / dt, 1000 * percentile(latencies, 0.5),
+                1000 * percentile(latencies, 0.99), 1000 * latencies[-1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
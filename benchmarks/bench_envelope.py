@@ -0,0 +1,49 @@
+"""
+Compares plain RSA and envelope encryption of ballots: throughput of
+encryption and decryption and size of the encrypted ballots.
+
+    python benchmarks/bench_envelope.py [ballots]
+"""
+import sys
+import json
+import time
+
+from human_security import HumanRSA
+
+from evote_ranking import Workflow
+
+
+def main(ballots=200):
+    h1 = HumanRSA()
+    h1.generate()
+    h2 = HumanRSA()
+    h2.generate()
+    private_rsa = HumanRSA()
+    private_rsa.load_private_pem(h1.private_pem())
+    print('%10s %10s %12s %12s %10s' % ('metadata', 'mode', 'encrypt/s', 'decrypt/s', 'bytes'))
+    for metadata_size in (0, 50, 1000, 10000):
+        ballot = {'number': 1, 'creation_timestamp': '2019-01-01 00:00:00.000000',
+                  'uuid': '00000000-0000-4000-8000-000000000000',
+                  'preference': ['Tim', 'John', 'Matt'],
+                  'metadata': 'x' * metadata_size}
+        serialized_ballot = json.dumps(ballot)
+        for envelope in (False, True):
+            mode = 'envelope' if envelope else 'rsa'
+            workflow = Workflow('.', h1.public_pem(), h2.private_pem(), envelope=envelope)
+            try:
+                t0 = time.perf_counter()
+                encrypted = [workflow.encrypt_serialized_ballot(serialized_ballot)
+                             for k in range(ballots)]
+                t1 = time.perf_counter()
+                for data in encrypted:
+                    workflow.decrypt_serialized_ballot(data, private_rsa)
+                t2 = time.perf_counter()
+            except ValueError:
+                print('%10i %10s %12s %12s %10s' % (metadata_size, mode, 'too large', '', ''))
+                continue
+            print('%10i %10s %12.1f %12.1f %10i' % (
+                metadata_size, mode, ballots / (t1 - t0), ballots / (t2 - t1), len(encrypted[0])))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
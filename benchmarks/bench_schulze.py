@@ -0,0 +1,95 @@
+"""
+Compares the dict based schulze implementation with the matrix engine
+(numpy and array fallback) across candidate counts.
+
+    python benchmarks/bench_schulze.py [ballots]
+"""
+import sys
+import time
+import random
+from functools import reduce
+
+from evote_ranking import algorithms
+
+
+def schulze_dict(preferences):
+    """the original dict keyed implementation, kept as a reference"""
+    d = {}
+    p = {}
+    # sorted as in algorithms.schulze so that ties are broken in the same order
+    candidates = sorted(reduce(
+        lambda a, b: a & b,
+        [set(preference) for preference in preferences]
+        ))
+    map_candid = dict((k, i) for (i, k) in enumerate(candidates))
+    n = len(candidates)
+    for i in range(n):
+        for j in range(n):
+            d[i, j] = p[i, j] = 0
+    for preference in preferences:
+        algorithms.assert_valid(preference)
+        for i in range(0, n - 1):
+            for j in range(i + 1, n):
+                key = (map_candid[preference[i]], map_candid[preference[j]])
+                d[key] += 1
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                p[i, j] = d[i, j] if d[i, j] > d[j, i] else 0
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                for k in range(n):
+                    if k != i and k != j:
+                        p[j, k] = max(p[j, k], min(p[j, i], p[i, k]))
+    winners = list(range(n))
+    winners.sort(key=algorithms.cmp_to_key(lambda i, j: algorithms.cmp(p[i, j], p[j, i])))
+    winners = [(i, candidates[k]) for (i, k) in enumerate(winners)]
+    winners.reverse()
+    return winners
+
+
+def make_preferences(n, ballots, distinct=200):
+    """random election where ballots are drawn from a limited number of rankings"""
+    candidates = ['C%.3i' % i for i in range(n)]
+    rankings = [random.sample(candidates, n) for i in range(distinct)]
+    return [list(random.choice(rankings)) for i in range(ballots)]
+
+
+def timeit(func, preferences):
+    t0 = time.perf_counter()
+    results = func(preferences)
+    return time.perf_counter() - t0, results
+
+
+def schulze_array(preferences):
+    numpy, algorithms.numpy = algorithms.numpy, None
+    try:
+        return algorithms.schulze(preferences)
+    finally:
+        algorithms.numpy = numpy
+
+
+def main(ballots=10000):
+    random.seed(1)
+    engines = [('dict', schulze_dict), ('array', schulze_array)]
+    if algorithms.numpy is not None:
+        engines.append(('numpy', algorithms.schulze))
+    print('%10s %10s' % ('candidates', 'ballots') +
+          ''.join('%12s' % name for name, _ in engines))
+    for n in (5, 10, 20, 40):
+        preferences = make_preferences(n, ballots)
+        timings = []
+        expected = None
+        for name, func in engines:
+            dt, results = timeit(func, preferences)
+            if expected is None:
+                expected = results
+            elif results != expected:
+                raise RuntimeError('%s engine results differ' % name)
+            timings.append(dt)
+        print('%10i %10i' % (n, ballots) + ''.join('%11.3fs' % dt for dt in timings))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
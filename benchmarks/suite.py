@@ -0,0 +1,253 @@
+"""
+Benchmark and profiling suite for the ranking algorithms and the ballot workflow.
+
+    python benchmarks/suite.py [--quick] [--output results.json]
+                               [--baseline benchmarks/baseline.json] [--save-baseline]
+
+For every synthetic electorate (impartial culture, clustered, polarized), number
+of candidates and number of voters it times each ranking algorithm and records
+its peak memory. Then it runs a small election through the Workflow (setup,
+create_ballots, cast_vote, decrypt_ballots, audit, count_votes) under cProfile
+and splits the time of each operation in stages: listdir, io, lock, hashing,
+rsa, json, tally and other.
+
+Results are written as JSON. With --baseline every algorithm result is compared
+with the one of the same name in the baseline and the script exits with status 1
+if any is slower than the baseline by more than --tolerance (default 0.5 = 50%)
+and by more than --slack seconds (default 0.01). The workflow steps are single
+profiled runs of a small election, too noisy to gate on, they are only reported.
+The stored baseline was recorded with --quick.
+"""
+import os
+import sys
+import json
+import time
+import random
+import pstats
+import cProfile
+import argparse
+import platform
+import tempfile
+import functools
+import tracemalloc
+
+from human_security import HumanRSA
+
+from evote_ranking import (simple_majority, instant_runoff, borda, schulze, rank_all,
+                           BallotProfile, Workflow)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# results reported but not compared with the baseline
+UNGATED = ('workflow/',)
+
+ALGORITHMS = {
+    'simple_majority': simple_majority,
+    'instant_runoff': instant_runoff,
+    'borda': borda,
+    'borda_fractional': functools.partial(borda, mode='fractional'),
+    'schulze': schulze,
+}
+
+# (candidates, voters) of each run
+FULL = {'candidates': (3, 5, 10, 20), 'voters': (1000, 10000, 100000), 'election': 200}
+QUICK = {'candidates': (3, 5, 10), 'voters': (1000, 10000), 'election': 20}
+
+
+# synthetic electorates
+
+def impartial_culture(candidates, voters, rng):
+    """every ranking is equally likely"""
+    return [rng.sample(candidates, len(candidates)) for k in range(voters)]
+
+
+def _perturbed(center, rng, dispersion):
+    """the center ranking where each adjacent pair is swapped with probability dispersion"""
+    preference = list(center)
+    for i in range(len(preference) - 1):
+        if rng.random() < dispersion:
+            preference[i], preference[i + 1] = preference[i + 1], preference[i]
+    return preference
+
+
+def clustered(candidates, voters, rng, clusters=3, dispersion=0.3):
+    """voters are split in clusters, each voting close to its own ranking"""
+    centers = [rng.sample(candidates, len(candidates)) for k in range(clusters)]
+    return [_perturbed(rng.choice(centers), rng, dispersion) for k in range(voters)]
+
+
+def polarized(candidates, voters, rng, dispersion=0.2):
+    """two camps voting close to opposite rankings"""
+    center = rng.sample(candidates, len(candidates))
+    centers = [center, center[::-1]]
+    return [_perturbed(rng.choice(centers), rng, dispersion) for k in range(voters)]
+
+
+GENERATORS = {
+    'impartial': impartial_culture,
+    'clustered': clustered,
+    'polarized': polarized,
+}
+
+
+# measurements
+
+def measure(func, *args, repeat=3):
+    """returns (result, best of repeat seconds, peak memory in KB) of func(*args),
+    memory is traced in a separate run since tracing slows it down"""
+    timings = []
+    for k in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(timings), peak // 1024
+
+
+def stage_of(filename, function):
+    """the stage a profiled function belongs to"""
+    if function in ('<built-in method posix.listdir>', '<built-in method posix.scandir>'):
+        return 'listdir'
+    if ('human_security' in filename or 'cryptography' in filename or 'cryptography' in function
+            or 'rsa' in function.lower() or 'load_pem' in function):
+        return 'rsa'
+    if 'hashlib' in function or 'hashlib' in filename or '_blake2' in function:
+        return 'hashing'
+    if os.sep + 'json' + os.sep in filename or 'json' in function:
+        return 'json'
+    if filename.endswith(('algorithms.py', 'profile.py', 'live.py')):
+        return 'tally'
+    if 'filelock' in filename or 'filelock' in function or 'fcntl' in function:
+        return 'lock'
+    if function.startswith(('<built-in method io.', '<built-in method posix.', '<built-in method _io.')) \
+            or "of '_io." in function:
+        return 'io'
+    return 'other'
+
+
+def profile_stages(func, *args):
+    """returns (result, seconds, {stage: seconds}) of func(*args) run under cProfile,
+    each function contributes its own time (not including its callees) to its stage"""
+    profiler = cProfile.Profile()
+    t0 = time.perf_counter()
+    result = profiler.runcall(func, *args)
+    seconds = time.perf_counter() - t0
+    stages = dict((stage, 0.0) for stage in ('listdir', 'io', 'lock', 'hashing', 'rsa', 'json', 'tally', 'other'))
+    for (filename, line, function), row in pstats.Stats(profiler).stats.items():
+        # row = (primitive calls, calls, own time, cumulative time, callers)
+        stages[stage_of(filename, function)] += row[2]
+    return result, seconds, stages
+
+
+# benchmarks
+
+def bench_algorithms(config, seed=1, repeat=3):
+    results = []
+    for generator_name, generator in GENERATORS.items():
+        for n in config['candidates']:
+            candidates = ['c%02i' % i for i in range(n)]
+            for voters in config['voters']:
+                preferences = generator(candidates, voters, random.Random(seed))
+                for name, algorithm in ALGORITHMS.items():
+                    _, seconds, peak_kb = measure(algorithm, preferences, repeat=repeat)
+                    results.append({
+                        'name': 'algorithm/%s/%s/%i/%i' % (name, generator_name, n, voters),
+                        'seconds': seconds, 'peak_kb': peak_kb})
+                _, seconds, peak_kb = measure(rank_all, preferences, list(ALGORITHMS.values()), repeat=repeat)
+                results.append({
+                    'name': 'algorithm/rank_all/%s/%i/%i' % (generator_name, n, voters),
+                    'seconds': seconds, 'peak_kb': peak_kb,
+                    'distinct': len(BallotProfile(preferences).keys())})
+    return results
+
+
+def bench_workflow(config, seed=1):
+    rng = random.Random(seed)
+    h1, h2 = HumanRSA(), HumanRSA()
+    h1.generate()
+    h2.generate()
+    votes = config['election']
+    candidates = ['Tim', 'John', 'Matt', 'Anna', 'Lucy']
+    preferences = impartial_culture(candidates, votes, rng)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        workflow = Workflow(folder, h1.public_pem(), h2.private_pem())
+        def cast_votes():
+            for k, preference in enumerate(preferences):
+                workflow.cast_vote('voter-%i' % k, preference)
+        steps = [
+            ('setup', workflow.setup, ()),
+            ('register_candidates', workflow.register_candidates, (candidates,)),
+            ('register_voters', workflow.register_voters, (['voter-%i' % k for k in range(votes)],)),
+            ('create_ballots', workflow.create_ballots, (votes,)),
+            ('cast_vote', cast_votes, ()),
+            ('decrypt_ballots', workflow.decrypt_ballots, (h1.private_pem(),)),
+            ('audit', workflow.audit, (h2.public_pem(),)),
+            ('count_votes', workflow.count_votes_multi, (list(ALGORITHMS.values()),)),
+        ]
+        for name, func, args in steps:
+            tracemalloc.start()
+            _, seconds, stages = profile_stages(func, *args)
+            peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+            results.append({'name': 'workflow/%s/%i' % (name, votes),
+                            'seconds': seconds, 'peak_kb': peak_kb, 'stages': stages})
+    return results
+
+
+def compare(results, baseline, tolerance, slack=0.01):
+    """returns the results slower than in the baseline by more than tolerance
+    (and by more than slack seconds, the shortest runs are mostly noise)"""
+    previous = dict((result['name'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        if result['name'].startswith(UNGATED):
+            continue
+        old = previous.get(result['name'])
+        if old and result['seconds'] > max(old['seconds'] * (1 + tolerance), old['seconds'] + slack):
+            regressions.append((result['name'], old['seconds'], result['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller runs')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='baseline to compare with (e.g. %s)' % BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative slowdown')
+    parser.add_argument('--slack', type=float, default=0.01, help='allowed slowdown in seconds')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results to %s' % BASELINE)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='algorithm timings are the best of repeat runs')
+    args = parser.parse_args()
+    config = QUICK if args.quick else FULL
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'config': config,
+        'results': bench_algorithms(config, args.seed, args.repeat) + bench_workflow(config, args.seed),
+    }
+    for result in report['results']:
+        stages = ' '.join('%s=%.3f' % item for item in result.get('stages', {}).items() if item[1] >= 0.0005)
+        print('%-48s %10.4f s %10i KB  %s' % (result['name'], result['seconds'], result['peak_kb'], stages))
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    if args.save_baseline:
+        with open(BASELINE, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(report['results'], json.load(fp), args.tolerance, args.slack)
+        for name, old, new in regressions:
+            print('REGRESSION %s: %.4f s -> %.4f s' % (name, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
-from . algorithms import (simple_majority, instant_runoff, borda, schulze)
+from . algorithms import (simple_majority, instant_runoff, borda, schulze, rank_all)
+from . profile import BallotProfile
 from . workflow import Workflow
 
 __version__ = '0.6'
@@ -0,0 +1,99 @@
+"""
+Distributed counting of the decrypted ballots.
+
+    python -m evote_ranking count WORKDIR [--shard I/N] [--workers W] [--output TALLY]
+    python -m evote_ranking merge TALLY [TALLY ...] [--algorithm NAME ...] [--output TALLY]
+
+count writes the partial tally of shard I of N (the ballots whose number % N == I,
+by default all of them) counted with W local processes, merge combines the partial
+tallies of all shards (in any order) and prints the rankings as JSON.
+"""
+import sys
+import json
+import argparse
+
+from . storage import SQLiteStorage, ArchiveStorage
+from . tally import PartialTally
+from . workflow import Workflow
+
+ALGORITHMS = {
+    'simple_majority': lambda tally: tally.simple_majority(),
+    'instant_runoff': lambda tally: tally.instant_runoff(),
+    'borda': lambda tally: tally.borda(),
+    'borda_fractional': lambda tally: [(float(v), k) for v, k in tally.borda('fractional', exact=True)],
+    'borda_exponential': lambda tally: tally.borda('exponential'),
+    'schulze': lambda tally: tally.schulze(),
+}
+
+
+def shard_spec(spec):
+    """I/N with 0 <= I < N"""
+    try:
+        shard, shards = map(int, spec.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected I/N, got %r' % spec)
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError('shard %s is not in 0..%i (shards are numbered from 0)'
+                                         % (spec, shards - 1))
+    return shard, shards
+
+
+def count(args):
+    shard, shards = args.shard
+    if args.sqlite:
+        storage = SQLiteStorage(args.sqlite)
+    elif args.archive:
+        storage = ArchiveStorage(args.workdir)
+    else:
+        storage = None
+    workflow = Workflow(args.workdir, None, None, storage=storage)
+    tally = workflow.count_partial(shard, shards, workers=args.workers, rankings=not args.no_rankings)
+    if args.output:
+        tally.save(args.output)
+    else:
+        json.dump(tally.to_dict(), sys.stdout)
+        sys.stdout.write('\n')
+
+
+def merge(args):
+    tallies = [PartialTally.load(path) for path in args.tallies]
+    tally = tallies[0]
+    for other in tallies[1:]:
+        tally.merge(other)
+    if not tally.complete:
+        sys.exit('missing shards %s of %i' % (', '.join(map(str, tally.missing)), tally.shards))
+    if args.output:
+        tally.save(args.output)
+    names = args.algorithm or [name for name in ALGORITHMS
+                               if tally.profile is not None or name != 'instant_runoff']
+    results = dict((name, ALGORITHMS[name](tally)) for name in names)
+    results['total'] = tally.total
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m evote_ranking', description=__doc__.split('\n\n')[0].strip())
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_count = commands.add_parser('count', help='count a shard of the decrypted ballots')
+    parser_count.add_argument('workdir')
+    parser_count.add_argument('--shard', default=(0, 1), type=shard_spec,
+                              help='I/N counts the ballots with number %% N == I (0 <= I < N)')
+    parser_count.add_argument('--workers', type=int, default=None, help='local processes')
+    parser_count.add_argument('--sqlite', help='path of the database of a SQLiteStorage election')
+    parser_count.add_argument('--archive', action='store_true', help='workdir is a packed export')
+    parser_count.add_argument('--no-rankings', action='store_true',
+                              help='do not keep the distinct rankings (no instant_runoff)')
+    parser_count.add_argument('--output', help='where to write the partial tally (default stdout)')
+    parser_count.set_defaults(func=count)
+    parser_merge = commands.add_parser('merge', help='merge partial tallies and rank the candidates')
+    parser_merge.add_argument('tallies', nargs='+')
+    parser_merge.add_argument('--algorithm', action='append', choices=sorted(ALGORITHMS))
+    parser_merge.add_argument('--output', help='where to write the merged tally')
+    parser_merge.set_defaults(func=merge)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
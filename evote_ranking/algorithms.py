@@ -1,7 +1,18 @@
 from functools import reduce
+from array import array
 import collections
+import functools
+import fractions
+import math
 
-__all__ = ['simple_majority', 'instant_runoff', 'borda', 'schulze']
+try:
+    import numpy
+except ImportError:  # numpy is optional, fall back to array rows
+    numpy = None
+
+from . profile import BallotProfile, as_profile
+
+__all__ = ['simple_majority', 'instant_runoff', 'borda', 'schulze', 'rank_all']
 
 
 def cmp(a, b):
@@ -33,116 +44,236 @@ def assert_valid(preference):
     if len(preference) != len(set(preference)):
         raise ValueError('Invalid preference. Candidate name is repeated')
 
+def weighted(preferences):
+    """iterates over (preference, count) in a single pass over a list,
+    a generator or a BallotProfile of preferences"""
+    if isinstance(preferences, BallotProfile):
+        return iter(preferences.items())
+    return ((preference, 1) for preference in preferences)
+
+
 def simple_majority(preferences):
     """simple majority ranking"""
-    votes = collections.defaultdict(int)
-    for preference in preferences:
-        if preference:
-            votes[preference[0]] += 1
-    votes_list = [(v, k) for k, v in votes.items()]
+    if isinstance(preferences, BallotProfile):
+        votes = preferences.first_choices()
+    else:
+        votes = collections.defaultdict(int)
+        for preference, count in weighted(preferences):
+            if preference:
+                votes[preference[0]] += count
+    return _ranking(votes)
+
+
+def _ranking(scores):
+    """returns [(score, candidate), ...] sorted from the winner to the loser"""
+    votes_list = [(v, k) for k, v in scores.items()]
     votes_list.sort(reverse=True)
     return votes_list
 
 
-def instant_runoff(preferences):
-    """instant run-off ranking"""
+def instant_runoff(preferences, trace=False):
+    """instant run-off ranking
+    if trace=True returns (winners, rounds) where rounds lists for every round
+    the tally of the remaining candidates and the candidates eliminated"""
     # winners is a list of (v,k) = (number of preferences, option number)
     # ordered from the candidate with the least preferences to the highest
+    rankings = list(as_profile(preferences).items())
+    # piles maps each remaining candidate to the distinct ballots which have
+    # it as current top choice, pointers[u] is the position of that choice in
+    # the u-th ballot, so each round only the piles of the losers are moved
+    piles = {}
+    tally = {}
+    pointers = [0] * len(rankings)
+    for preference, count in rankings:
+        # check the preference for the ballot is valid
+        assert_valid(preference)
+        # important! all options must be in the tally even if nobody
+        # choose them as their first option else 0 counts would not be present
+        for item in preference:
+            if not item in tally:
+                piles[item] = []
+                tally[item] = 0
+    for u, (preference, count) in enumerate(rankings):
+        if preference:
+            piles[preference[0]].append(u)
+            tally[preference[0]] += count
     winners = []
-    losers = set()
-    allowed_options = reduce(
-        lambda a, b: a | b, [set(preference) for preference in preferences])
-    n = len(allowed_options)
-    while len(winners) < n:
-        # options maps candidates to count of ballots
-        # who preferenced for that candidate in first place
-        # after ignoring some candidates
-        options = {}
-        # important! options must be initialized to that all options
-        # are present, even nobody choose them as their first option
-        # else 0 counts would not be present
-        for item in allowed_options:
-            if not item in losers:
-                options[item] = 0
-        # for every ballot
-        for preference in preferences:
-            # check the preference for the ballot is valid
-            assert_valid(preference)
-            # for each voting option in this balloe
-            for item in preference:
-                # if the option(candidate) have not been
-                # alreday discurded
-                if not item in losers:
-                    # count how many ballot have this option
-                    # as first option
-                    options[item] += 1
-                    break
-
-        # find the option(candidate) with the least number of
-        # top preferences
-        options_list = [(v, k) for (k, v) in options.items()]
+    rounds = []
+    while tally:
+        # find the options(candidates) with the least number of
+        # top preferences and discard them
+        options_list = [(v, k) for (k, v) in tally.items()]
         options_list.sort()
         minv = options_list[0][0]
-        # discard this option and count again
-        for (v, k) in options_list:
-            if v == minv:
-                losers.add(k)
-                winners.insert(0, (v, k))
+        losers = [k for (v, k) in options_list if v == minv]
+        rounds.append({'round': len(rounds) + 1,
+                       'tally': dict(tally),
+                       'eliminated': losers})
+        for k in losers:
+            winners.insert(0, (minv, k))
+            del tally[k]
+        # move the ballots of the losers to their next remaining option
+        for k in losers:
+            for u in piles.pop(k):
+                preference, count = rankings[u]
+                i = pointers[u] + 1
+                while i < len(preference) and not preference[i] in tally:
+                    i += 1
+                pointers[u] = i
+                if i < len(preference):
+                    piles[preference[i]].append(u)
+                    tally[preference[i]] += count
+    if trace:
+        return winners, rounds
     return winners
 
 
-def borda(preferences, mode='linear'):
-    """borda ranking when mode=linear (default)"""
+@functools.lru_cache(maxsize=64)
+def borda_weights(mode, n, size=None, scale=1):
+    """the score of each of the first size (default n) positions of a ballot ranking
+    n candidates, scale multiplies the fractional weights so they are integers
+    when scale is a multiple of 1, 2, ..., size (see borda exact=True)"""
+    size = n if size is None else size
+    if mode == 'linear':
+        return tuple(n - k for k in range(size))
+    elif mode == 'fractional':
+        if scale > 1:
+            return tuple(scale // (k + 1) for k in range(size))
+        return tuple(1.0 / (k + 1) for k in range(size))
+    elif mode == 'exponential':
+        return tuple(n ** (n - k - 1) for k in range(size))
+    raise RuntimeError("mode not supported")
+
+
+def borda(preferences, mode='linear', exact=False):
+    """borda ranking when mode=linear (default)
+    ballots are tallied in a candidate x position count matrix which is scored
+    once with the weights of the mode for n = number of candidates ranked in any
+    ballot, if exact=True fractional scores are Fractions (summed as integers)
+    so they do not depend on the order of the ballots"""
     if not mode in ('linear', 'fractional', 'exponential'):
         raise RuntimeError("mode not supported")
-    winners = {}
-    n = len(preferences[0])
-    for preference in preferences:
+    if isinstance(preferences, BallotProfile):
+        # the candidate x position matrix is shared with the other algorithms
+        return _borda_ranking(preferences.position_counts(), mode, exact)
+    positions = {}
+    for preference, count in weighted(preferences):
         assert_valid(preference)
         for k, item in enumerate(preference):
-            if mode == 'linear':
-                delta = (n - k)
-            elif mode == 'fractional':
-                delta = 1.0 / (k + 1)
-            elif mode == 'exponential':
-                delta = n ** (n - k - 1)
-            winners[item] = winners.get(item, 0) + delta
-    winners = [(v, k) for (k, v) in winners.items()]
-    winners.sort(reverse=True)
-    return winners
+            counts = positions.get(item)
+            if counts is None:
+                counts = positions[item] = []
+            if k >= len(counts):
+                counts.extend([0] * (k + 1 - len(counts)))
+            counts[k] += count
+    return _borda_ranking(positions, mode, exact)
 
 
-def schulze(preferences):
-    """schulze ranking algorithm"""
-    d = {}
-    p = {}
-    candidates = list(reduce(
-        lambda a, b: a & b,
-        [set(preference) for preference in preferences]
-        ))
-    map_candid = dict((k, i) for (i, k) in enumerate(candidates))
+def _borda_ranking(positions, mode, exact=False):
+    """borda ranking from {candidate: number of ballots ranking it in each position}
+    of the candidates ranked in any ballot"""
+    n = len(positions)
+    scale = 1
+    if exact and mode == 'fractional':
+        # least common multiple of 1, 2, ..., n
+        for k in range(2, n + 1):
+            scale = scale * k // math.gcd(scale, k)
+    weights = borda_weights(mode, n, n, scale)
+    winners = {}
+    for item, counts in positions.items():
+        score = sum(weight * count for weight, count in zip(weights, counts) if count)
+        winners[item] = fractions.Fraction(score, scale) if scale > 1 else score
+    return _ranking(winners)
+
+
+def _pairwise_matrix(rankings, candidates):
+    """builds d[i][j] = number of ballots preferring candidates[i] over candidates[j]
+    rankings is a list of (preference, count) with identical ballots grouped"""
     n = len(candidates)
-    for i in range(n):
-        for j in range(n):
-            d[i, j] = p[i, j] = 0
-    for preference in preferences:
-        assert_valid(preference)
+    map_candid = dict((k, i) for (i, k) in enumerate(candidates))
+    if numpy is not None:
+        # positions[u, c] is the rank of candidate c in the u-th distinct ballot
+        counts = numpy.array([count for _, count in rankings], dtype=numpy.int64)
+        positions = numpy.empty((len(rankings), n), dtype=numpy.int64)
+        for u, (preference, _) in enumerate(rankings):
+            positions[u, [map_candid[item] for item in preference if item in map_candid]] = numpy.arange(n)
+        d = numpy.zeros((n, n), dtype=numpy.int64)
+        for i in range(n):
+            d[i] = counts @ (positions[:, i, None] < positions)
+        return d
+    d = [array('q', [0] * n) for i in range(n)]
+    for preference, count in rankings:
+        # the relative order of the candidates (ballots may rank others too)
+        indices = [map_candid[item] for item in preference if item in map_candid]
         for i in range(0, n - 1):
+            row = d[indices[i]]
             for j in range(i + 1, n):
-                key = (map_candid[preference[i]], map_candid[preference[j]])
-                d[key] += 1
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                p[i, j] = d[i, j] if d[i, j] > d[j, i] else 0
+                row[indices[j]] += count
+    return d
+
+
+def _strongest_paths(d):
+    """computes the widest paths p[i][j] from the pairwise matrix d (Floyd-Warshall)"""
+    n = len(d)
+    if numpy is not None:
+        p = numpy.where(d > d.T, d, 0)
+        for i in range(n):
+            # row i and column i are not modified at step i so the update can
+            # be applied to the whole matrix at once
+            p = numpy.maximum(p, numpy.minimum(p[:, i, None], p[i, None, :]))
+        numpy.fill_diagonal(p, 0)
+        return p.tolist()
+    p = [array('q', [d[i][j] if d[i][j] > d[j][i] else 0 for j in range(n)])
+         for i in range(n)]
     for i in range(n):
+        row_i = p[i]
         for j in range(n):
-            if i != j:
-                for k in range(n):
-                    if k != i and k != j:
-                        p[j, k] = max(p[j, k], min(p[j, i], p[i, k]))
+            p_ji = p[j][i]
+            if j == i or not p_ji:
+                continue
+            row_j = p[j]
+            for k in range(n):
+                if k != i and k != j:
+                    v = row_i[k] if row_i[k] < p_ji else p_ji
+                    if v > row_j[k]:
+                        row_j[k] = v
+    return p
+
+
+def schulze(preferences):
+    """schulze ranking algorithm"""
+    profile = as_profile(preferences)
+    # the candidates ranked in every ballot, sorted so that ties are broken
+    # in the same order by every counting path
+    candidates = sorted(reduce(
+        lambda a, b: a & b,
+        [set(preference) for preference in profile.keys()]
+        ))
+    rankings = list(profile.items())
+    for preference, count in rankings:
+        assert_valid(preference)
+    d = profile.cached(('pairwise', tuple(candidates)),
+                       lambda: _pairwise_matrix(rankings, candidates))
+    return _schulze_ranking(d, candidates)
+
+
+def _schulze_ranking(d, candidates):
+    """schulze ranking from the pairwise matrix d of the candidates"""
+    n = len(candidates)
+    if numpy is not None:
+        d = numpy.asarray(d, dtype=numpy.int64).reshape(n, n)
+    p = _strongest_paths(d)
     winners = list(range(n))
-    winners.sort(key=cmp_to_key(lambda i, j: cmp(p[i, j], p[j, i])))
+    winners.sort(key=cmp_to_key(lambda i, j: cmp(p[i][j], p[j][i])))
     winners = [(i, candidates[k]) for (i, k) in enumerate(winners)]
     winners.reverse()
     return winners
+
+
+def rank_all(preferences, algorithms):
+    """returns the ranking of every algorithm in algorithms (use functools.partial
+    for options such as the borda mode) reading the preferences only once: the
+    algorithms count the same profile and share its intermediate structures
+    (first choices, candidate x position counts, pairwise matrix)"""
+    profile = as_profile(preferences)
+    return [algorithm(profile) for algorithm in algorithms]
@@ -0,0 +1,127 @@
+import os
+import mmap
+import struct
+import bisect
+
+__all__ = ['Archive', 'write_archive']
+
+# header: magic, number of entries, width of the name field
+HEADER = struct.Struct('<8sQI4x')
+MAGIC = b'EVARCH01'
+# each entry in the table is followed by offset and length of the payload
+OFFSETS = struct.Struct('<QQ')
+
+
+def write_archive(path, items):
+    """writes (name, data) items into a single indexed archive file and returns the names
+    the archive has a fixed width table (sorted by name) followed by the concatenated
+    payloads so it can be memory mapped and read without unpacking"""
+    entries = []
+    payloads_path = path + '.payloads'
+    offset = 0
+    with open(payloads_path, 'wb') as fp:
+        for name, data in items:
+            data = data.encode() if isinstance(data, str) else data
+            fp.write(data)
+            entries.append((name.encode(), offset, len(data)))
+            offset += len(data)
+    entries.sort()
+    width = max([len(name) for name, _, _ in entries] + [1])
+    table_size = len(entries) * (width + OFFSETS.size)
+    base = HEADER.size + table_size
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(entries), width))
+        fp.write(b''.join(name.ljust(width, b'\0') + OFFSETS.pack(base + offset, length)
+                          for name, offset, length in entries))
+        with open(payloads_path, 'rb') as payloads:
+            while True:
+                chunk = payloads.read(1 << 20)
+                if not chunk:
+                    break
+                fp.write(chunk)
+    os.unlink(payloads_path)
+    os.replace(tmp_path, path)
+    return [name.decode() for name, _, _ in entries]
+
+
+class Archive:
+    """read-only memory mapped view of an archive created by write_archive,
+    archive[name] returns a zero-copy memoryview of the payload"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.width = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a ballot archive' % path)
+        self.entry_size = self.width + OFFSETS.size
+        self.view = memoryview(self.mmap)
+
+    def name(self, i):
+        """name of the i-th entry (entries are sorted by name)"""
+        start = HEADER.size + i * self.entry_size
+        return bytes(self.view[start:start + self.width]).rstrip(b'\0').decode()
+
+    def entry(self, i):
+        """returns (name, payload) of the i-th entry"""
+        start = HEADER.size + i * self.entry_size
+        offset, length = OFFSETS.unpack_from(self.mmap, start + self.width)
+        return self.name(i), self.view[offset:offset + length]
+
+    def find(self, name):
+        """index of name in the table or -1 (binary search)"""
+        names = _Names(self)
+        i = bisect.bisect_left(names, name)
+        return i if i < self.count and names[i] == name else -1
+
+    def get(self, name, default=None):
+        i = self.find(name)
+        return self.entry(i)[1] if i >= 0 else default
+
+    def __getitem__(self, name):
+        i = self.find(name)
+        if i < 0:
+            raise KeyError(name)
+        return self.entry(i)[1]
+
+    def __contains__(self, name):
+        return self.find(name) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def names(self):
+        return [self.name(i) for i in range(self.count)]
+
+    def items(self):
+        for i in range(self.count):
+            yield self.entry(i)
+
+    def close(self):
+        try:
+            self.view.release()
+            self.mmap.close()
+        except BufferError:
+            # payload slices are still in use, the map is freed with them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Names:
+    """sequence view of the names in an archive, used for bisect"""
+
+    def __init__(self, archive):
+        self.archive = archive
+
+    def __len__(self):
+        return self.archive.count
+
+    def __getitem__(self, i):
+        return self.archive.name(i)
@@ -0,0 +1,121 @@
+import os
+import struct
+from array import array
+
+from filelock import FileLock
+
+from . algorithms import _ranking, _borda_ranking, _schulze_ranking
+
+__all__ = ['LiveTally']
+
+
+class LiveTally:
+    """running tally of the cast votes for provisional results
+
+    keeps the number of ballots, the first choice counts, the candidate x
+    position counts (borda) and the pairwise matrix (schulze) of the
+    registered candidates as int64 in a small file, so every vote updates it
+    in O(n^2) under a file lock and results are read without recounting.
+    With path=None the tally is kept in memory (used to check it at close).
+    It reveals the running results, only use it when that is acceptable"""
+
+    magic = b'EVLIVE01'
+
+    def __init__(self, path, candidates):
+        self.path = path
+        self.candidates = list(candidates)
+        self.index = dict((c, i) for (i, c) in enumerate(self.candidates))
+        self.lock = FileLock(path + '.lock') if path else None
+        n = len(self.candidates)
+        self.size = 1 + n + 2 * n * n
+        self._values = None if path else array('q', [0] * self.size)
+
+    def _header(self):
+        return self.magic + struct.pack('<Q', len(self.candidates))
+
+    def read(self):
+        """returns all the counters as an array (zeros if nothing was recorded)"""
+        if self._values is not None:
+            return self._values
+        values = array('q', [0] * self.size)
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as fp:
+                if fp.read(16) != self._header():
+                    raise RuntimeError('live tally does not match the candidates')
+                values = array('q')
+                values.frombytes(fp.read())
+        return values
+
+    def _update(self, values, preference, count):
+        n = len(self.candidates)
+        indices = [self.index[item] for item in preference]
+        values[0] += count
+        if indices:
+            values[1 + indices[0]] += count
+        positions, pairwise = 1 + n, 1 + n + n * n
+        for k, i in enumerate(indices):
+            values[positions + i * n + k] += count
+            # only pairs of ranked candidates, as in the pairwise matrix of schulze
+            for j in indices[k + 1:]:
+                values[pairwise + i * n + j] += count
+
+    def add(self, preference, count=1):
+        """records count ballots with the given preference"""
+        if self._values is not None:
+            self._update(self._values, preference, count)
+            return
+        with self.lock:
+            values = self.read()
+            self._update(values, preference, count)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as fp:
+                fp.write(self._header() + values.tobytes())
+            os.replace(tmp, self.path)
+
+    def reset(self):
+        """forgets all recorded ballots"""
+        if self._values is not None:
+            self._values = array('q', [0] * self.size)
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+    @property
+    def total(self):
+        return self.read()[0]
+
+    def first_choices(self):
+        values = self.read()
+        return dict((c, values[1 + i]) for (i, c) in enumerate(self.candidates))
+
+    def position_counts(self):
+        values = self.read()
+        n, start = len(self.candidates), 1 + len(self.candidates)
+        return dict((c, values[start + i * n: start + (i + 1) * n].tolist())
+                    for (i, c) in enumerate(self.candidates))
+
+    def pairwise(self):
+        values = self.read()
+        n, start = len(self.candidates), 1 + len(self.candidates) + len(self.candidates) ** 2
+        return [values[start + i * n: start + (i + 1) * n] for i in range(n)]
+
+    def simple_majority(self):
+        return _ranking(dict((c, v) for (c, v) in self.first_choices().items() if v))
+
+    def borda(self, mode='linear', exact=False):
+        # only the candidates ranked in some ballot, as borda does
+        positions = dict((c, counts) for (c, counts) in self.position_counts().items() if any(counts))
+        return _borda_ranking(positions, mode, exact)
+
+    def schulze(self):
+        # the candidates ranked in every ballot in the same order as schulze
+        total = self.total
+        positions = self.position_counts()
+        ranked = sorted(c for c in self.candidates if sum(positions[c]) == total)
+        indices = [self.index[c] for c in ranked]
+        pairwise = self.pairwise()
+        d = [array('q', [pairwise[i][j] for j in indices]) for i in indices]
+        return _schulze_ranking(d, ranked)
+
+    def __eq__(self, other):
+        return (isinstance(other, LiveTally) and self.candidates == other.candidates
+                and self.read() == other.read())
@@ -0,0 +1,130 @@
+import time
+import bisect
+import threading
+import http.server
+
+__all__ = ['NullMetrics', 'InMemoryMetrics']
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullMetrics:
+    """default metrics, records nothing
+
+    Workflow and the storages call count(name) and time blocks with
+    `with metrics.timer(name):`, here both are no-ops (timer always returns
+    the same object) so uninstrumented elections pay almost nothing"""
+
+    _timer = _NullTimer()
+
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return self._timer
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Timer:
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.t0)
+
+
+class InMemoryMetrics(NullMetrics):
+    """thread safe counters and timing histograms kept in memory
+
+    timings are recorded in cumulative buckets (upper bounds in seconds) as
+    prometheus histograms, render() returns them in the prometheus text
+    format and serve() exposes them over HTTP to be scraped"""
+
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, prefix='evote'):
+        self.prefix = prefix
+        self.counters = {}
+        # name -> [counts per bucket (the last one is +Inf), sum of seconds]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][i] += 1
+            histogram[1] += seconds
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """returns {'counters': {name: value}, 'timings': {name: {'count', 'sum', 'buckets'}}}"""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': dict((name, {'count': sum(counts), 'sum': total, 'buckets': list(counts)})
+                                for name, (counts, total) in self.histograms.items()),
+            }
+
+    def render(self):
+        """the metrics in the prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = '%s_%s_total' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %s' % (metric, value))
+        for name, timing in sorted(snapshot['timings'].items()):
+            metric = '%s_%s_seconds' % (self.prefix, name)
+            lines.append('# TYPE %s histogram' % metric)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), timing['buckets']):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %i' % (metric, bound, cumulative))
+            lines.append('%s_sum %r' % (metric, timing['sum']))
+            lines.append('%s_count %i' % (metric, timing['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """serves render() over HTTP from a daemon thread, returns the server
+        (server.server_address is the bound address, server.shutdown() stops it)"""
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,107 @@
+import os
+import random
+
+from filelock import FileLock
+
+from . metrics import NULL_METRICS
+
+__all__ = ['BallotPool']
+
+
+class BallotPool:
+    """index of the available blank ballots for constant time random picking
+
+    the names are stored in a file as fixed width records (a slot array),
+    claiming a ballot picks a random slot and moves the last record in its
+    place (swap-remove) while holding a file lock, so concurrent voters never
+    claim the same ballot. The index can always be rebuilt from the folder"""
+
+    header_size = 8
+    # time spent waiting for the lock is recorded as lock_wait
+    metrics = NULL_METRICS
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path + '.lock')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _width(self, fp):
+        fp.seek(0)
+        return int(fp.read(self.header_size))
+
+    def _count(self, fp, width):
+        fp.seek(0, os.SEEK_END)
+        return (fp.tell() - self.header_size) // width
+
+    def _read(self, fp, width, i):
+        fp.seek(self.header_size + i * width)
+        return fp.read(width).decode().rstrip()
+
+    def _write(self, names, width=64):
+        """(re)writes the index with the given names, must be called with the lock held"""
+        width = max([width] + [len(name) + 1 for name in names])
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(b'%07i\n' % width)
+            fp.write(b''.join(name.ljust(width - 1).encode() + b'\n' for name in names))
+        os.replace(tmp_path, self.path)
+
+    def names(self):
+        """returns the names of all ballots in the pool"""
+        with open(self.path, 'rb') as fp:
+            width = self._width(fp)
+            fp.seek(self.header_size)
+            data = fp.read().decode()
+        return [data[i:i + width].rstrip() for i in range(0, len(data), width)]
+
+    def rebuild(self, names):
+        """replaces the content of the index with names"""
+        with self.lock:
+            self._write(list(names))
+
+    def add(self, names):
+        """appends names to the index"""
+        names = list(names)
+        with self.lock:
+            if not self.exists():
+                return self._write(names)
+            with open(self.path, 'r+b') as fp:
+                width = self._width(fp)
+                if all(len(name) < width for name in names):
+                    fp.seek(0, os.SEEK_END)
+                    fp.write(b''.join(name.ljust(width - 1).encode() + b'\n' for name in names))
+                    return
+            # some name does not fit in a record, rewrite with wider records
+            self._write(self.names() + names, width)
+
+    def claim(self, take):
+        """picks a random ballot and removes it from the index
+        take(name) is called with the lock held and must return False if the
+        ballot can no longer be taken (then another one is picked)
+        returns the name of the claimed ballot or None if the pool is empty"""
+        with self.metrics.timer('lock_wait'):
+            self.lock.acquire()
+        try:
+            with open(self.path, 'r+b') as fp:
+                width = self._width(fp)
+                while True:
+                    count = self._count(fp, width)
+                    if not count:
+                        return None
+                    i = random.randrange(count)
+                    name = self._read(fp, width, i)
+                    if i != count - 1:
+                        last = self._read(fp, width, count - 1)
+                        fp.seek(self.header_size + i * width)
+                        fp.write(last.ljust(width - 1).encode() + b'\n')
+                    fp.truncate(self.header_size + (count - 1) * width)
+                    if take(name):
+                        return name
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        with open(self.path, 'rb') as fp:
+            return self._count(fp, self._width(fp))
@@ -0,0 +1,99 @@
+__all__ = ['BallotProfile']
+
+
+class BallotProfile:
+    """stores the distinct preferences (as tuples) with the number of ballots casting each one
+
+    real elections have far fewer distinct rankings than ballots so all the
+    ranking algorithms accept a profile in place of a list of preferences
+    and weight each distinct preference by its count. Iterating a profile
+    yields every ballot (each preference repeated count times) so algorithms
+    written for a list of preferences count it correctly, keys() and items()
+    give the distinct preferences"""
+
+    def __init__(self, preferences=None):
+        self.counts = {}
+        self.total = 0
+        # intermediate structures shared by the ranking algorithms
+        self.cache = {}
+        if preferences is not None:
+            self.extend(preferences)
+
+    def add(self, preference, count=1):
+        """records count ballots with the given preference"""
+        key = tuple(preference)
+        self.counts[key] = self.counts.get(key, 0) + count
+        self.total += count
+        if self.cache:
+            self.cache.clear()
+
+    def extend(self, preferences):
+        """adds a list (or any iterable) of preferences or another profile"""
+        if isinstance(preferences, BallotProfile):
+            for preference, count in preferences.items():
+                self.add(preference, count)
+        else:
+            for preference in preferences:
+                self.add(preference)
+
+    def cached(self, key, compute):
+        """returns compute() computing it only once until the profile changes,
+        so several algorithms counting the same profile share the work"""
+        if not key in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def first_choices(self):
+        """returns {candidate: number of ballots ranking it first}"""
+        def compute():
+            votes = {}
+            for preference, count in self.counts.items():
+                if preference:
+                    votes[preference[0]] = votes.get(preference[0], 0) + count
+            return votes
+        return self.cached('first_choices', compute)
+
+    def position_counts(self):
+        """returns {candidate: counts} where counts[k] is the number of ballots
+        ranking the candidate in position k (the candidate x position matrix)"""
+        def compute():
+            size = max(map(len, self.counts), default=0)
+            positions = {}
+            for preference, count in self.counts.items():
+                if len(preference) != len(set(preference)):
+                    raise ValueError('Invalid preference. Candidate name is repeated')
+                for k, item in enumerate(preference):
+                    if not item in positions:
+                        positions[item] = [0] * size
+                    positions[item][k] += count
+            return positions
+        return self.cached('position_counts', compute)
+
+    def keys(self):
+        """returns the distinct preferences in order of first appearance"""
+        return self.counts.keys()
+
+    def items(self):
+        """returns (preference, count) pairs in order of first appearance"""
+        return self.counts.items()
+
+    def __iter__(self):
+        for preference, count in self.counts.items():
+            for k in range(count):
+                yield preference
+
+    def __len__(self):
+        return self.total
+
+    def __eq__(self, other):
+        return isinstance(other, BallotProfile) and self.counts == other.counts
+
+    def __repr__(self):
+        return 'BallotProfile(%i ballots, %i distinct)' % (self.total, len(self.counts))
+
+
+def as_profile(preferences):
+    """returns preferences as a BallotProfile (without copying if it is one already)"""
+    if isinstance(preferences, BallotProfile):
+        return preferences
+    return BallotProfile(preferences)
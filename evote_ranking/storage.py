@@ -0,0 +1,782 @@
+import os
+import re
+import json
+import shutil
+import bisect
+import random
+import sqlite3
+import threading
+
+from filelock import FileLock
+
+from . pool import BallotPool
+from . metrics import NULL_METRICS
+from . archive import Archive, write_archive
+
+__all__ = ['FolderStorage', 'SQLiteStorage', 'ArchiveStorage']
+
+
+class EVoteError(RuntimeError): pass
+
+
+re_blank = re.compile(r'^ballot\.\d+\.blank\.[\w]+\.json$')
+re_encrypted = re.compile(r'^ballot\.\d+\.encrypted\.[\w]+\.json$')
+re_decrypted = re.compile(r'^ballot\.\d+\.decrypted\.[\w]+\.json$')
+re_signature = re.compile(r'^ballot\.\d+\.encrypted\.[\w]+\.signature$')
+re_pack = re.compile(r'^ballots\.(\d+)-(\d+)\.pack$')
+
+
+def number_of(ballot_name):
+    """the ballot number from a ballot (or signature) name"""
+    return int(ballot_name.split('.')[1])
+
+
+class FolderStorage:
+    """the election stored as files using the public folder layout
+
+    - blank_ballots: un-encrypted blank ballots (and packed archives of blank ballots)
+    - voting_ballots: blank ballots are moved here while a vote is recorded
+    - encrypted_ballots: encrypted voted ballots
+    - decrypted_ballots: decrypted voted ballots
+    - signatures: one signature file for every encrypted voted ballot
+    - voters: one file with the state of each voter (in subfolders by code prefix)
+    """
+
+    # voters are sharded in subfolders named after the first characters of their code
+    shard_size = 3
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.pool = BallotPool(os.path.join(workdir, 'blank_ballots.index'))
+        # the packed archives loaded so far by name and their (first, last, name) ranges, sorted
+        self._packs = {}
+        self._pack_ranges = []
+        self.metrics = NULL_METRICS
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        """counters and timings (lock_wait) are recorded in metrics, also by the pool"""
+        self._metrics = self.pool.metrics = metrics
+
+    def __getstate__(self):
+        return {'workdir': self.workdir}
+
+    def __setstate__(self, state):
+        self.__init__(state['workdir'])
+
+    def folder(self, subfolder):
+        return os.path.join(self.workdir, subfolder)
+
+    def get_path(self, name, folder=None):
+        """given ballot name, builds the full path to the ballot file (folder is optional)"""
+        if not folder:
+            folder = name.split('.')[2] + '_ballots'
+        return os.path.join(self.workdir, folder, name)
+
+    def setup(self):
+        """creates all folders"""
+        os.mkdir(self.folder('blank_ballots'))  # ballots avaliable
+        os.mkdir(self.folder('voting_ballots')) # ballots not available
+        os.mkdir(self.folder('encrypted_ballots'))  # ballots voted
+        os.mkdir(self.folder('decrypted_ballots'))  # ballots voted
+        os.mkdir(self.folder('signatures'))  # signatures of voted ballots
+        os.mkdir(self.folder('voters'))
+        self.pool.rebuild([])  # index of the blank ballots
+
+    # manifest and candidates
+
+    def save_manifest(self, manifest):
+        with open(os.path.join(self.workdir, 'election.json'), 'w') as fp:
+            json.dump(manifest, fp)
+
+    def load_manifest(self):
+        """the election manifest or None (elections created before manifests)"""
+        try:
+            with open(os.path.join(self.workdir, 'election.json')) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def save_candidates(self, candidates):
+        with open(os.path.join(self.workdir, 'candidates.json'), 'w') as fp:
+            json.dump(candidates, fp)
+
+    def load_candidates(self):
+        with open(os.path.join(self.workdir, 'candidates.json')) as fp:
+            return json.load(fp)
+
+    # voters
+
+    def voter_path(self, voter_code):
+        """voters/{prefix}/{voter_code}.json where prefix are the first characters of the code,
+        voters registered before sharding (voters/{voter_code}.json) are still found"""
+        path = os.path.join(self.workdir, 'voters', voter_code[:self.shard_size], voter_code + '.json')
+        if not os.path.exists(path):
+            flat_path = os.path.join(self.workdir, 'voters', voter_code + '.json')
+            if os.path.exists(flat_path):
+                return flat_path
+        return path
+
+    def add_voter(self, voter_code, voted=False):
+        path = self.voter_path(voter_code)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            json.dump({'voter_code': voter_code, 'voted': voted}, fp)
+
+    def add_voters(self, voter_codes):
+        """registers many voters, creating each shard folder only once"""
+        folder = self.folder('voters')
+        shards = set(os.listdir(folder))
+        count = 0
+        for voter_code in voter_codes:
+            shard = voter_code[:self.shard_size]
+            if not shard in shards:
+                os.makedirs(os.path.join(folder, shard), exist_ok=True)
+                shards.add(shard)
+            with open(os.path.join(folder, shard, voter_code + '.json'), 'w') as fp:
+                fp.write(json.dumps({'voter_code': voter_code, 'voted': False}))
+            count += 1
+        return count
+
+    def migrate_voters(self):
+        """moves voters from the flat voters folder into the shard folders"""
+        folder = self.folder('voters')
+        count = 0
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name.endswith('.lock') and os.path.isfile(path):
+                os.unlink(path)
+            elif name.endswith('.json'):
+                shard_folder = os.path.join(folder, name[:self.shard_size])
+                os.makedirs(shard_folder, exist_ok=True)
+                with FileLock(path + '.lock'):
+                    os.rename(path, os.path.join(shard_folder, name))
+                os.unlink(path + '.lock')
+                count += 1
+        return count
+
+    def _set_voted(self, voter_code, voted):
+        voter_filename = self.voter_path(voter_code)
+        if not os.path.exists(voter_filename):
+            raise EVoteError('Voter is not allowed to vote')
+        lock = FileLock(voter_filename + '.lock')
+        with self.metrics.timer('lock_wait'):
+            lock.acquire()
+        try:
+            with open(voter_filename, 'r') as fp:
+                voter_info = json.load(fp)
+            if voted and voter_info['voted']:
+                raise EVoteError('Voter has voted already')
+            voter_info['voted'] = voted
+            with open(voter_filename, 'w') as fp:
+                json.dump(voter_info, fp)
+        finally:
+            lock.release()
+
+    def has_voted(self, voter_code):
+        """lock-free check, returns None if the voter is unknown else whether the voter voted"""
+        try:
+            with open(self.voter_path(voter_code)) as fp:
+                return json.load(fp)['voted']
+        except (FileNotFoundError, ValueError):
+            # unknown or being written, claim_voter will tell
+            return None
+
+    def claim_voter(self, voter_code):
+        """marks the voter as voted, raises EVoteError if the voter is unknown or voted already"""
+        self._set_voted(voter_code, True)
+
+    def release_voter(self, voter_code):
+        """marks the voter as not voted (when recording the vote failed)"""
+        self._set_voted(voter_code, False)
+
+    def iter_voters(self):
+        """yields (voter_code, voted) for all voters"""
+        folder = self.folder('voters')
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.isdir(path):
+                names = [os.path.join(path, subname) for subname in os.listdir(path)]
+            else:
+                names = [path]
+            for path in names:
+                if path.endswith('.json'):
+                    with open(path) as fp:
+                        voter_info = json.load(fp)
+                    yield voter_info['voter_code'], voter_info['voted']
+
+    # blank ballots
+
+    def begin_blank_ballots(self):
+        """prepares the staging folder used by add_blank_ballots(..., staging=True)"""
+        staging_folder = self.folder('blank_ballots.tmp')
+        if os.path.exists(staging_folder):
+            shutil.rmtree(staging_folder)
+        os.mkdir(staging_folder)
+
+    def add_blank_ballots(self, ballots, packed=False, staging=False):
+        """stores (name, serialized ballot) items and returns their names, if packed
+        they are stored in a single archive, if staging they are only made available
+        (and added to the pool) by end_blank_ballots"""
+        folder = self.folder('blank_ballots.tmp' if staging else 'blank_ballots')
+        if packed:
+            ballots = list(ballots)
+            numbers = [number_of(name) for name, _ in ballots] or [0]
+            path = os.path.join(folder, 'ballots.%.6i-%.6i.pack' % (min(numbers), max(numbers)))
+            ballot_names = write_archive(path, ballots)
+        else:
+            ballot_names = []
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+            for ballot_name, serialized_ballot in ballots:
+                fd = os.open(os.path.join(folder, ballot_name), flags, 0o666)
+                try:
+                    os.write(fd, serialized_ballot.encode())
+                finally:
+                    os.close(fd)
+                ballot_names.append(ballot_name)
+        if not staging:
+            self.add_to_pool(ballot_names)
+        return ballot_names
+
+    def end_blank_ballots(self, ballot_names):
+        """moves the staged ballots in blank_ballots and makes them available"""
+        blank_folder = self.folder('blank_ballots')
+        staging_folder = self.folder('blank_ballots.tmp')
+        with os.scandir(blank_folder) as entries:
+            empty = next(entries, None) is None
+        if empty:
+            # a single rename puts all the ballots in place
+            os.rmdir(blank_folder)
+            os.rename(staging_folder, blank_folder)
+        else:
+            for name in os.listdir(staging_folder):
+                os.rename(os.path.join(staging_folder, name), os.path.join(blank_folder, name))
+            os.rmdir(staging_folder)
+        self.add_to_pool(ballot_names)
+
+    def load_packs(self):
+        """loads the packed archives added to blank_ballots since the last call"""
+        folder = self.folder('blank_ballots')
+        for name in os.listdir(folder):
+            match = re_pack.match(name)
+            if match and not name in self._packs:
+                self._packs[name] = Archive(os.path.join(folder, name))
+                bisect.insort(self._pack_ranges, (int(match.group(1)), int(match.group(2)), name))
+
+    def packs(self):
+        """returns the packed blank ballot archives"""
+        self.load_packs()
+        return [self._packs[name] for first, last, name in self._pack_ranges]
+
+    def find_pack(self, number):
+        """the loaded archive whose range (from its name) contains the ballot number or None"""
+        i = bisect.bisect_right(self._pack_ranges, (number, float('inf')))
+        if i and self._pack_ranges[i - 1][1] >= number:
+            return self._packs[self._pack_ranges[i - 1][2]]
+        return None
+
+    def read_packed_ballot(self, ballot_name):
+        """returns the content of a blank ballot from the packed archives or None,
+        blank_ballots is only listed again if no loaded archive has it"""
+        number = number_of(ballot_name)
+        for reload in (False, True):
+            if reload:
+                self.load_packs()
+            archive = self.find_pack(number)
+            data = archive.get(ballot_name) if archive is not None else None
+            if data is not None:
+                return bytes(data).decode()
+        return None
+
+    def iter_blank_names(self):
+        """yields the names of the blank ballots still available, from files and archives"""
+        used = set()
+        for name in os.listdir(self.folder('blank_ballots')):
+            if re_blank.match(name):
+                used.add(number_of(name))
+                yield name
+        packs = self.packs()
+        if packs:
+            used.update(number_of(name) for name in self.iter_voting_names())
+            used.update(number_of(name) for name in self.iter_encrypted_names())
+        for archive in packs:
+            for name in archive.names():
+                if not number_of(name) in used:
+                    yield name
+
+    def iter_blank(self):
+        """yields (name, serialized ballot) of the blank ballots still available"""
+        for name in self.iter_blank_names():
+            path = self.get_path(name)
+            if os.path.exists(path):
+                with open(path) as fp:
+                    yield name, fp.read()
+            else:
+                yield name, self.read_packed_ballot(name)
+
+    def iter_voting_names(self):
+        return (name for name in os.listdir(self.folder('voting_ballots')) if re_blank.match(name))
+
+    def rebuild_pool(self):
+        """rebuilds the index of blank ballots from the blank_ballots folder"""
+        self.pool.rebuild(self.iter_blank_names())
+
+    def add_to_pool(self, ballot_names):
+        """makes ballots already in blank_ballots available, elections created before
+        the index have none, then it is built from the folder (including ballot_names)"""
+        if self.pool.exists():
+            self.pool.add(ballot_names)
+        else:
+            self.rebuild_pool()
+
+    def claim_blank_ballot(self):
+        """picks a random blank ballot and moves it to voting_ballots, returns (name, content)
+        or None if there are no blank ballots left"""
+        if not self.pool.exists():
+            self.rebuild_pool()
+        def take(ballot_name):
+            # moves the ballot while the pool is locked, skips stale index entries
+            destination_path = self.get_path(ballot_name, 'voting_ballots')
+            try:
+                shutil.move(self.get_path(ballot_name), destination_path)
+            except FileNotFoundError:
+                serialized_ballot = self.read_packed_ballot(ballot_name)
+                if serialized_ballot is None or os.path.exists(destination_path):
+                    return False
+                with open(destination_path, 'w') as fp:
+                    fp.write(serialized_ballot)
+            return True
+        ballot_name = self.pool.claim(take)
+        if ballot_name is None:
+            return None
+        with open(self.get_path(ballot_name, 'voting_ballots')) as fp:
+            return ballot_name, fp.read()
+
+    def release_ballot(self, ballot_name):
+        """moves a voting ballot back to blank_ballots"""
+        shutil.move(self.get_path(ballot_name, 'voting_ballots'), self.get_path(ballot_name))
+        self.add_to_pool([ballot_name])
+
+    def remove_voting_ballot(self, ballot_name):
+        os.unlink(self.get_path(ballot_name, 'voting_ballots'))
+
+    # voted ballots
+
+    def save_encrypted(self, ballot_name, encrypted_ballot, signature_name, signature):
+        """saves an encrypted voted ballot and its signature"""
+        with open(self.get_path(ballot_name), 'wb') as fp:
+            fp.write(encrypted_ballot)
+        with open(os.path.join(self.folder('signatures'), signature_name), 'wb') as fp:
+            fp.write(signature.encode() if isinstance(signature, str) else signature)
+
+    def remove_encrypted(self, ballot_name, signature_name):
+        for path in (self.get_path(ballot_name),
+                     os.path.join(self.folder('signatures'), signature_name)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def iter_encrypted_names(self):
+        return (name for name in os.listdir(self.folder('encrypted_ballots')) if re_encrypted.match(name))
+
+    def read_encrypted(self, ballot_name):
+        with open(self.get_path(ballot_name), 'rb') as fp:
+            return fp.read()
+
+    def iter_signature_names(self):
+        return (name for name in os.listdir(self.folder('signatures')) if re_signature.match(name))
+
+    def read_signature(self, signature_name):
+        with open(os.path.join(self.folder('signatures'), signature_name)) as fp:
+            return fp.read()
+
+    def save_decrypted(self, ballot_name, serialized_ballot):
+        if not isinstance(serialized_ballot, str):
+            serialized_ballot = bytes(serialized_ballot).decode()
+        path = self.get_path(ballot_name)
+        # write then rename so an interrupted run never leaves a partial ballot
+        with open(path + '.tmp', 'w') as fp:
+            fp.write(serialized_ballot)
+        os.replace(path + '.tmp', path)
+
+    def iter_decrypted_names(self):
+        return (name for name in os.listdir(self.folder('decrypted_ballots')) if re_decrypted.match(name))
+
+    def read_decrypted(self, ballot_name):
+        with open(self.get_path(ballot_name)) as fp:
+            return fp.read()
+
+    def iter_decrypted(self):
+        """yields (name, serialized ballot) of the decrypted ballots"""
+        with os.scandir(self.folder('decrypted_ballots')) as entries:
+            for entry in entries:
+                if re_decrypted.match(entry.name):
+                    with open(entry.path) as fp:
+                        yield entry.name, fp.read()
+
+
+class SQLiteStorage:
+    """the election stored in a local SQLite database (in WAL mode)
+
+    ballots are indexed by status, blank ballots are claimed from a slot table
+    with swap-remove and voters are flagged inside transactions, so concurrent
+    processes can vote safely. Use Workflow.export to produce the public folders"""
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS voters (code TEXT PRIMARY KEY, voted INTEGER NOT NULL DEFAULT 0)',
+        'CREATE TABLE IF NOT EXISTS ballots (name TEXT PRIMARY KEY, number INTEGER NOT NULL, '
+        'status TEXT NOT NULL, data BLOB)',
+        'CREATE INDEX IF NOT EXISTS ballots_status ON ballots (status, number)',
+        'CREATE TABLE IF NOT EXISTS blank_slots (slot INTEGER PRIMARY KEY, name TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS signatures (name TEXT PRIMARY KEY, data TEXT NOT NULL)',
+    ]
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        # waits for the write lock (BEGIN IMMEDIATE) are recorded as lock_wait
+        self.metrics = NULL_METRICS
+
+    def __getstate__(self):
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['timeout'])
+
+    @property
+    def db(self):
+        """one connection per thread and per process"""
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def transaction(self):
+        """context manager for a write transaction"""
+        return _Transaction(self.db, self.metrics)
+
+    def setup(self):
+        with self.transaction() as db:
+            for statement in self.schema:
+                db.execute(statement)
+
+    # manifest and candidates
+
+    def save_manifest(self, manifest):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('manifest', json.dumps(manifest)))
+
+    def load_manifest(self):
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE key='manifest'").fetchone()
+        except sqlite3.OperationalError:
+            # not setup yet
+            return None
+        return json.loads(row[0]) if row else None
+
+    def save_candidates(self, candidates):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('candidates', json.dumps(candidates)))
+
+    def load_candidates(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key='candidates'").fetchone()
+        return json.loads(row[0])
+
+    # voters
+
+    def add_voter(self, voter_code, voted=False):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO voters VALUES (?, ?)', (voter_code, int(voted)))
+
+    def add_voters(self, voter_codes, batch_size=10000):
+        """registers many voters, one transaction per batch"""
+        count = 0
+        voter_codes = iter(voter_codes)
+        while True:
+            batch = [(voter_code,) for _, voter_code in zip(range(batch_size), voter_codes)]
+            if not batch:
+                return count
+            with self.transaction() as db:
+                db.executemany('INSERT OR REPLACE INTO voters VALUES (?, 0)', batch)
+            count += len(batch)
+
+    def migrate_voters(self):
+        return 0
+
+    def has_voted(self, voter_code):
+        """returns None if the voter is unknown else whether the voter voted"""
+        row = self.db.execute('SELECT voted FROM voters WHERE code=?', (voter_code,)).fetchone()
+        return None if row is None else bool(row[0])
+
+    def claim_voter(self, voter_code):
+        """marks the voter as voted, raises EVoteError if the voter is unknown or voted already"""
+        with self.transaction() as db:
+            cursor = db.execute('UPDATE voters SET voted=1 WHERE code=? AND voted=0', (voter_code,))
+            if cursor.rowcount == 1:
+                return
+            row = db.execute('SELECT voted FROM voters WHERE code=?', (voter_code,)).fetchone()
+        if row is None:
+            raise EVoteError('Voter is not allowed to vote')
+        raise EVoteError('Voter has voted already')
+
+    def release_voter(self, voter_code):
+        with self.transaction() as db:
+            db.execute('UPDATE voters SET voted=0 WHERE code=?', (voter_code,))
+
+    def iter_voters(self):
+        for code, voted in self.db.execute('SELECT code, voted FROM voters'):
+            yield code, bool(voted)
+
+    # blank ballots
+
+    def begin_blank_ballots(self):
+        pass
+
+    def add_blank_ballots(self, ballots, packed=False, staging=False):
+        """stores (name, serialized ballot) items and returns their names"""
+        ballots = [(name, number_of(name), data) for name, data in ballots]
+        with self.transaction() as db:
+            db.executemany("INSERT INTO ballots VALUES (?, ?, 'blank', ?)", ballots)
+            db.executemany('INSERT INTO blank_slots (name) VALUES (?)',
+                           [(name,) for name, _, _ in ballots])
+        return [name for name, _, _ in ballots]
+
+    def end_blank_ballots(self, ballot_names):
+        pass
+
+    def iter_blank_names(self):
+        return (row[0] for row in self.db.execute(
+            "SELECT name FROM ballots WHERE status='blank' ORDER BY number"))
+
+    def iter_blank(self):
+        return iter(self.db.execute(
+            "SELECT name, data FROM ballots WHERE status='blank' ORDER BY number").fetchall())
+
+    def iter_voting_names(self):
+        return (row[0] for row in self.db.execute(
+            "SELECT name FROM ballots WHERE status='voting' ORDER BY number"))
+
+    def rebuild_pool(self):
+        """rebuilds the slots of blank ballots from the ballots table"""
+        with self.transaction() as db:
+            db.execute('DELETE FROM blank_slots')
+            db.execute("INSERT INTO blank_slots (name) SELECT name FROM ballots "
+                       "WHERE status='blank' ORDER BY number")
+
+    def claim_blank_ballot(self):
+        """picks a random blank ballot and marks it as voting, returns (name, content)
+        or None if there are no blank ballots left"""
+        with self.transaction() as db:
+            count = db.execute('SELECT max(slot) FROM blank_slots').fetchone()[0]
+            if not count:
+                return None
+            slot = random.randrange(count) + 1
+            name = db.execute('SELECT name FROM blank_slots WHERE slot=?', (slot,)).fetchone()[0]
+            if slot != count:
+                db.execute('UPDATE blank_slots SET name=(SELECT name FROM blank_slots WHERE slot=?) '
+                           'WHERE slot=?', (count, slot))
+            db.execute('DELETE FROM blank_slots WHERE slot=?', (count,))
+            db.execute("UPDATE ballots SET status='voting' WHERE name=?", (name,))
+            data = db.execute('SELECT data FROM ballots WHERE name=?', (name,)).fetchone()[0]
+        return name, data
+
+    def release_ballot(self, ballot_name):
+        with self.transaction() as db:
+            db.execute("UPDATE ballots SET status='blank' WHERE name=?", (ballot_name,))
+            db.execute('INSERT INTO blank_slots (name) VALUES (?)', (ballot_name,))
+
+    def remove_voting_ballot(self, ballot_name):
+        with self.transaction() as db:
+            db.execute("DELETE FROM ballots WHERE name=? AND status='voting'", (ballot_name,))
+
+    # voted ballots
+
+    def save_encrypted(self, ballot_name, encrypted_ballot, signature_name, signature):
+        with self.transaction() as db:
+            db.execute("INSERT INTO ballots VALUES (?, ?, 'encrypted', ?)",
+                       (ballot_name, number_of(ballot_name), encrypted_ballot))
+            db.execute('INSERT INTO signatures VALUES (?, ?)', (signature_name, signature))
+
+    def remove_encrypted(self, ballot_name, signature_name):
+        with self.transaction() as db:
+            db.execute('DELETE FROM ballots WHERE name=?', (ballot_name,))
+            db.execute('DELETE FROM signatures WHERE name=?', (signature_name,))
+
+    def iter_encrypted_names(self):
+        return (row[0] for row in self.db.execute(
+            "SELECT name FROM ballots WHERE status='encrypted' ORDER BY number"))
+
+    def read_encrypted(self, ballot_name):
+        return self.db.execute('SELECT data FROM ballots WHERE name=?', (ballot_name,)).fetchone()[0]
+
+    def iter_signature_names(self):
+        return (row[0] for row in self.db.execute('SELECT name FROM signatures'))
+
+    def read_signature(self, signature_name):
+        return self.db.execute('SELECT data FROM signatures WHERE name=?', (signature_name,)).fetchone()[0]
+
+    def save_decrypted(self, ballot_name, serialized_ballot):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO ballots VALUES (?, ?, 'decrypted', ?)",
+                       (ballot_name, number_of(ballot_name), serialized_ballot))
+
+    def iter_decrypted_names(self):
+        return (row[0] for row in self.db.execute(
+            "SELECT name FROM ballots WHERE status='decrypted' ORDER BY number"))
+
+    def read_decrypted(self, ballot_name):
+        return self.db.execute('SELECT data FROM ballots WHERE name=?', (ballot_name,)).fetchone()[0]
+
+    def iter_decrypted(self):
+        cursor = self.db.cursor()
+        cursor.execute("SELECT name, data FROM ballots WHERE status='decrypted'")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+
+class ArchiveStorage:
+    """read-only election published as one archive per folder
+
+    - election.json and candidates.json
+    - voters.pack, blank_ballots.pack, encrypted_ballots.pack,
+      decrypted_ballots.pack and signatures.pack
+
+    each archive is memory mapped so observers can recount (Workflow.count_votes)
+    and verify (Workflow.audit) the election without unpacking it. Workflow.export
+    with a FolderStorage unpacks it into the folder layout"""
+
+    folders = ('voters', 'blank_ballots', 'encrypted_ballots', 'decrypted_ballots', 'signatures')
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self._archives = {}
+
+    def __getstate__(self):
+        return {'workdir': self.workdir}
+
+    def __setstate__(self, state):
+        self.__init__(state['workdir'])
+
+    def archive(self, folder):
+        """the archive of a folder (None if it was not published)"""
+        if not folder in self._archives:
+            path = os.path.join(self.workdir, folder + '.pack')
+            self._archives[folder] = Archive(path) if os.path.exists(path) else None
+        return self._archives[folder]
+
+    def _names(self, folder):
+        archive = self.archive(folder)
+        return archive.names() if archive else []
+
+    def _read(self, folder, name):
+        return self.archive(folder)[name]
+
+    def pack(self, storage):
+        """writes the content of another storage as archives"""
+        os.makedirs(self.workdir, exist_ok=True)
+        manifest = storage.load_manifest()
+        if manifest is not None:
+            with open(os.path.join(self.workdir, 'election.json'), 'w') as fp:
+                json.dump(manifest, fp)
+        with open(os.path.join(self.workdir, 'candidates.json'), 'w') as fp:
+            json.dump(storage.load_candidates(), fp)
+        def voters():
+            for voter_code, voted in storage.iter_voters():
+                yield voter_code + '.json', json.dumps({'voter_code': voter_code, 'voted': voted})
+        def encrypted():
+            for name in storage.iter_encrypted_names():
+                yield name, storage.read_encrypted(name)
+        def signatures():
+            for name in storage.iter_signature_names():
+                yield name, storage.read_signature(name)
+        for folder, items in (('voters', voters()),
+                              ('blank_ballots', storage.iter_blank()),
+                              ('encrypted_ballots', encrypted()),
+                              ('decrypted_ballots', storage.iter_decrypted()),
+                              ('signatures', signatures())):
+            write_archive(os.path.join(self.workdir, folder + '.pack'), items)
+        self._archives = {}
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.workdir, 'election.json')) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    def load_candidates(self):
+        with open(os.path.join(self.workdir, 'candidates.json')) as fp:
+            return json.load(fp)
+
+    def has_voted(self, voter_code):
+        archive = self.archive('voters')
+        data = archive and archive.get(voter_code + '.json')
+        return None if data is None else json.loads(bytes(data))['voted']
+
+    def iter_voters(self):
+        archive = self.archive('voters')
+        for name, data in (archive.items() if archive else []):
+            voter_info = json.loads(bytes(data))
+            yield voter_info['voter_code'], voter_info['voted']
+
+    def iter_blank_names(self):
+        return iter(self._names('blank_ballots'))
+
+    def iter_blank(self):
+        archive = self.archive('blank_ballots')
+        for name, data in (archive.items() if archive else []):
+            yield name, bytes(data).decode()
+
+    def iter_voting_names(self):
+        return iter([])
+
+    def iter_encrypted_names(self):
+        return iter(self._names('encrypted_ballots'))
+
+    def read_encrypted(self, ballot_name):
+        """a zero-copy memoryview of the encrypted ballot"""
+        return self._read('encrypted_ballots', ballot_name)
+
+    def iter_signature_names(self):
+        return iter(self._names('signatures'))
+
+    def read_signature(self, signature_name):
+        return bytes(self._read('signatures', signature_name)).decode()
+
+    def iter_decrypted_names(self):
+        return iter(self._names('decrypted_ballots'))
+
+    def read_decrypted(self, ballot_name):
+        return bytes(self._read('decrypted_ballots', ballot_name))
+
+    def iter_decrypted(self):
+        archive = self.archive('decrypted_ballots')
+        for name, data in (archive.items() if archive else []):
+            yield name, bytes(data)
+
+
+class _Transaction:
+
+    def __init__(self, db, metrics=NULL_METRICS):
+        self.db = db
+        self.metrics = metrics
+
+    def __enter__(self):
+        with self.metrics.timer('lock_wait'):
+            self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
@@ -0,0 +1,116 @@
+import json
+from array import array
+
+from . algorithms import instant_runoff
+from . profile import BallotProfile
+from . live import LiveTally
+
+__all__ = ['PartialTally']
+
+
+class PartialTally(LiveTally):
+    """counts of a shard of the ballots which can be saved, loaded and merged
+
+    it holds the first choice counts (simple_majority), the candidate x
+    position counts (borda), the pairwise matrix (schulze) and, unless
+    rankings=False, the distinct rankings with their counts (instant_runoff).
+    All are integer counts so merging the tallies of disjoint shards in any
+    order and grouping gives exactly the tally of all their ballots.
+    The tally records which of the shards it covers, merge refuses to count a
+    shard twice and complete tells whether all the shards were merged"""
+
+    version = 2
+
+    def __init__(self, candidates, rankings=True, shard=0, shards=1):
+        if not 0 <= shard < shards:
+            raise ValueError('Invalid shard %s of %s' % (shard, shards))
+        LiveTally.__init__(self, None, candidates)
+        self.profile = BallotProfile() if rankings else None
+        self.shards = shards
+        self.covered = {shard}
+
+    @property
+    def missing(self):
+        """the shards not yet merged in this tally"""
+        return sorted(set(range(self.shards)) - self.covered)
+
+    @property
+    def complete(self):
+        return not self.missing
+
+    def add(self, preference, count=1):
+        LiveTally.add(self, preference, count)
+        if self.profile is not None:
+            self.profile.add(preference, count)
+
+    def merge(self, other):
+        """adds the counts of other (the tally of other shards) to this one, returns self
+        the rankings are only kept if both tallies have them"""
+        if other.shards != self.shards:
+            raise ValueError('Cannot merge tallies of %i and %i shards' % (self.shards, other.shards))
+        if other.covered & self.covered:
+            raise ValueError('Shards %s merged twice' % sorted(other.covered & self.covered))
+        self.add_counts(other)
+        self.covered |= other.covered
+        return self
+
+    def add_counts(self, other):
+        """adds the counts of other (of the same shard) to this one"""
+        if other.candidates != self.candidates:
+            raise ValueError('Cannot merge tallies of different candidates')
+        values = self._values
+        for i, value in enumerate(other.read()):
+            values[i] += value
+        if self.profile is not None and other.profile is not None:
+            self.profile.extend(other.profile)
+        else:
+            self.profile = None
+
+    def instant_runoff(self, trace=False):
+        if self.profile is None:
+            raise RuntimeError('instant_runoff needs the rankings')
+        return instant_runoff(self.profile, trace=trace)
+
+    def to_dict(self):
+        n = len(self.candidates)
+        values = self.read().tolist()
+        positions, pairwise = 1 + n, 1 + n + n * n
+        return {
+            'version': self.version,
+            'candidates': self.candidates,
+            'shards': self.shards,
+            'covered': sorted(self.covered),
+            'total': values[0],
+            'first_choices': values[1:positions],
+            'positions': [values[positions + i * n:positions + (i + 1) * n] for i in range(n)],
+            'pairwise': [values[pairwise + i * n:pairwise + (i + 1) * n] for i in range(n)],
+            'rankings': None if self.profile is None else [
+                [list(preference), count] for preference, count in self.profile.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != cls.version:
+            raise ValueError('Unsupported tally version %s' % data.get('version'))
+        tally = cls(data['candidates'], rankings=data['rankings'] is not None,
+                    shards=data['shards'])
+        tally.covered = set(data['covered'])
+        if not tally.covered or not tally.covered <= set(range(tally.shards)):
+            raise ValueError('Invalid shards')
+        tally._values = array('q', [data['total']] + data['first_choices'] +
+                              [c for row in data['positions'] for c in row] +
+                              [c for row in data['pairwise'] for c in row])
+        if len(tally._values) != tally.size:
+            raise ValueError('Invalid tally')
+        for preference, count in data['rankings'] or []:
+            tally.profile.add(preference, count)
+        return tally
+
+    def save(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fp:
+            return cls.from_dict(json.load(fp))
@@ -4,16 +4,71 @@ import json
 import hashlib
 import datetime
 import uuid
-import random
-import shutil
+import struct
+import asyncio
 import logging
+import binascii
+import collections
+import concurrent.futures
 
-from pathlib import Path
+from human_security import HumanAES, HumanRSA
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
-from filelock import FileLock
-from human_security import HumanRSA
+from . profile import BallotProfile
+from . algorithms import rank_all
+from . live import LiveTally
+from . tally import PartialTally
+from . metrics import NULL_METRICS
+from . storage import EVoteError, FolderStorage, ArchiveStorage, number_of
+
+
+# header of envelope encrypted ballots (version 2), followed by the length of the
+# RSA wrapped key (2 bytes), the wrapped AES-256 key, the 12 bytes nonce and the
+# AES-GCM sealed ballot. Version 1 sealed the ballot with Fernet whose tokens carry
+# the time of encryption in clear (it would tell when each ballot was cast), it is
+# only read to decrypt existing ballots
+ENVELOPE_MAGIC = b'EVENV2'
+ENVELOPE_MAGIC_V1 = b'EVENV1'
+NONCE_SIZE = 12
+
+# state of each worker process, keys are loaded once per process
+_worker = {}
+
+def _init_decrypt_worker(workdir, public_key_1, private_key_2, storage, private_key_1):
+    h = HumanRSA()
+    h.load_private_pem(private_key_1)
+    _worker['workflow'] = Workflow(workdir, public_key_1, private_key_2, storage=storage)
+    _worker['rsa'] = h
+
+def _decrypt_batch(ballot_names):
+    workflow, h = _worker['workflow'], _worker['rsa']
+    return [workflow.decrypt_ballot(ballot_name, h) for ballot_name in ballot_names]
+
+def _create_ballot_batch(workdir, storage, start, stop, metadata, packed):
+    workflow = Workflow(workdir, None, None, storage=storage)
+    ballots = workflow.generate_ballots(start, stop, metadata)
+    return storage.add_blank_ballots(ballots, packed=packed, staging=True)
+
+def _init_audit_worker(public_key_2):
+    h = HumanRSA()
+    h.load_public_pem(public_key_2)
+    _worker['rsa'] = h
+
+def _verify(h, data, signature):
+    try:
+        return h.verify(data, signature)
+    except (binascii.Error, ValueError):
+        # malformed (e.g. not hex encoded) signature
+        return False
+
+def _verify_batch(items):
+    h = _worker['rsa']
+    return [(key, name, _verify(h, data, signature)) for key, name, data, signature in items]
+
+def _count_batch(workdir, storage, ballot_names, rankings):
+    workflow = Workflow(workdir, None, None, storage=storage)
+    return workflow.count_partial(ballot_names=ballot_names, rankings=rankings).to_dict()
 
-class EVoteError(RuntimeError): pass
 
 class Workflow:
 
@@ -21,32 +76,63 @@ class Workflow:
     re_encrypted = re.compile(r'^ballot\.\d+\.encrypted\.[\w]+\.json$')
     re_decrypted = re.compile(r'^ballot\.\d+\.decrypted\.[\w]+\.json$')
 
-    def __init__(self, workdir, public_key_1, private_key_2, logger=logging):
+    def __init__(self, workdir, public_key_1, private_key_2, logger=logging, storage=None,
+                 envelope=False, digest=None, live=False, metrics=None):
         self.workdir = workdir
         self.public_key_1 = public_key_1
         self.private_key_2 = private_key_2
-        self.logger = logger        
+        self.logger = logger
+        # if True ballots are sealed with a per-ballot symmetric key wrapped with RSA
+        self.envelope = envelope
+        # where ballots and voters are stored, by default the public folder layout
+        self.storage = storage or FolderStorage(workdir)
+        # counters and timing histograms of the hot path (see metrics.InMemoryMetrics)
+        self.metrics = metrics or NULL_METRICS
+        if metrics is not None:
+            self.storage.metrics = metrics
+        self._candidates = self._public_rsa = self._signing_rsa = None
+        # if True every cast vote also updates the running tally (see LiveTally)
+        self.live = live
+        # digest used by setup for a new election, existing elections use their manifest
+        self._digest = digest
+        self._manifest = None
 
     def setup(self):
-        """creates all folders"""
-        self.logger.info('BEGIN creating requied subfolders')
-        os.mkdir(os.path.join(self.workdir, 'blank_ballots'))  # ballots avaliable
-        os.mkdir(os.path.join(self.workdir, 'voting_ballots')) # ballots not available
-        os.mkdir(os.path.join(self.workdir, 'encrypted_ballots'))  # ballots voted
-        os.mkdir(os.path.join(self.workdir, 'decrypted_ballots'))  # ballots voted
-        os.mkdir(os.path.join(self.workdir, 'signatures'))  # signatures of voted ballots
-        os.mkdir(os.path.join(self.workdir, 'voters'))
-        self.logger.info('END creating requied subfolders')
+        """creates all folders (or tables) and the election manifest"""
+        self.logger.info('BEGIN creating required subfolders')
+        digest = self._digest or 'md5'
+        try:
+            # variable length digests (shake_*) have no hexdigest() without a length
+            hashlib.new(digest).hexdigest()
+        except (ValueError, TypeError):
+            raise ValueError('Unsupported digest %r (a fixed length hashlib algorithm is required)' % digest)
+        self.storage.setup()
+        self._manifest = {'version': 1, 'digest': digest}
+        self.storage.save_manifest(self._manifest)
+        self.logger.info('END creating required subfolders')
+
+    @property
+    def manifest(self):
+        """the election manifest (elections without one used md5)"""
+        if self._manifest is None:
+            self._manifest = self.storage.load_manifest() or {'version': 0, 'digest': 'md5'}
+        return self._manifest
+
+    @property
+    def digest(self):
+        """name of the hashlib algorithm used to hash ballot content"""
+        return self.manifest['digest']
 
     def hash(self, data):
         """used to hash ballot content"""
         data = data.encode() if isinstance(data, str) else data
-        return hashlib.md5(data).hexdigest()
+        return hashlib.new(self.digest, data).hexdigest()
 
     def verify_integrity(self, name, data):
         """check that content data of ballots matches hash in the name"""
-        self.logger.info('verifying ballot integrity %s' % name)
-        assert self.hash(data) == name.split('.')[3]
+        self.logger.debug('verifying ballot integrity %s', name)
+        with self.metrics.timer('verify'):
+            assert self.hash(data) == name.split('.')[3]
 
     def get_path(self, name, folder=None):
         """given ballot name, builds the full path to the ballot file (folder is optional)"""
@@ -56,192 +142,519 @@ class Workflow:
     
     def register_candidates(self, candidates):
         """saves the names of election candidates in candidates.json"""
-        self.logger.info('BEGIN registering cadidates')
+        self.logger.info('BEGIN registering candidates')
         for candidate in candidates:
-            self.logger.info('candidate:', candidate)
-        filename = os.path.join(self.workdir, 'candidates.json')
-        with open(filename, 'w') as fp:
-            json.dump(candidates, fp)
-        self.logger.info('END registering cadidates')
+            self.logger.debug('candidate: %s', candidate)
+        self.storage.save_candidates(candidates)
+        self._candidates = list(candidates)
+        if self.live:
+            self.live_tally.reset()
+        self.logger.info('END registering candidates')
         
     def register_voter(self, voter_id):
-        """regiters a new voter but creating a voters/{voter_code}.json file"""
+        """regiters a new voter but creating a voters/{prefix}/{voter_code}.json file"""
         voter_code = self.hash(voter_id)
-        self.logger.info('BEGIN registering voter' , voter_code)
-        filename = os.path.join(self.workdir, 'voters', voter_code+'.json')
-        with open(filename, 'w') as fp:
-            self.logger.info(filename)
-            json.dump({'voter_code': voter_code, 'voted': False}, fp)
-        self.logger.info('BEGIN registering voter')
-
-    def create_ballots(self, number, start=1, metadata=None):
-        """creates a black ballot for each voter, can store optional metadata in the ballots"""
-        self.logger.info('BEGIN creating blank ballots')
-        for k in range(start, start+number):
-            self.logger.info('creating ballot %.6i' % k)
+        self.logger.debug('BEGIN registering voter %s', voter_code)
+        self.storage.add_voter(voter_code)
+        self.logger.debug('END registering voter')
+
+    def register_voters(self, voter_ids):
+        """registers many voters from any iterable of voter_ids (a list, a generator,
+        the lines of a file) without loading them all in memory, returns the count
+        trailing newlines are removed from the voter_ids"""
+        self.logger.info('BEGIN registering voters')
+        count = self.storage.add_voters(self.hash(voter_id.rstrip('\r\n')) for voter_id in voter_ids)
+        self.logger.info('END registering %i voters', count)
+        return count
+
+    def migrate_voters(self):
+        """moves voters registered in a flat voters folder into the shard folders
+        (run it while the election is closed)"""
+        return self.storage.migrate_voters()
+
+    def generate_ballots(self, start, stop, metadata=None):
+        """yields (name, serialized ballot) of new blank ballots numbered from start to stop-1"""
+        # one timestamp per batch and the uuids from a single call to urandom
+        timestamp = str(datetime.datetime.utcnow())
+        randomness = os.urandom(16 * (stop - start))
+        for i, k in enumerate(range(start, stop)):
             ballot = {"number": k,
-                      "creation_timestamp": str(datetime.datetime.utcnow()),
-                      "uuid": str(uuid.uuid4()),
+                      "creation_timestamp": timestamp,
+                      "uuid": str(uuid.UUID(bytes=randomness[16 * i:16 * i + 16], version=4)),
                       "preference": [],
                       "metadata": metadata}
             serialized_ballot = json.dumps(ballot)
             ballot_hash = self.hash(serialized_ballot)
-            ballot_name = 'ballot.%.6i.blank.%s.json' % (k, ballot_hash)
-            ballot_path = self.get_path(ballot_name)
-            with open(ballot_path, 'w') as fp:
-                fp.write(serialized_ballot)
+            yield 'ballot.%.6i.blank.%s.json' % (k, ballot_hash), serialized_ballot
+
+    def create_ballots(self, number, start=1, metadata=None, workers=None, batch_size=10000, packed=False):
+        """creates a black ballot for each voter, can store optional metadata in the ballots
+        ballots are created in batches (in parallel if workers > 1) into a staging folder
+        then moved in blank_ballots. If packed=True each batch is stored in a single
+        blank_ballots/ballots.{start}-{stop}.pack archive instead of one file per ballot"""
+        self.logger.info('BEGIN creating blank ballots')
+        self.storage.begin_blank_ballots()
+        batches = [(self.workdir, self.storage, k, min(k + batch_size, start + number), metadata, packed)
+                   for k in range(start, start + number, batch_size)]
+        ballot_names = []
+        if not workers or workers == 1:
+            for batch in batches:
+                ballot_names += _create_ballot_batch(*batch)
+                self.logger.info('created ballots %.6i to %.6i', batch[2], batch[3] - 1)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                for batch, names in zip(batches, executor.map(_create_ballot_batch, *zip(*batches))):
+                    ballot_names += names
+                    self.logger.info('created ballots %.6i to %.6i', batch[2], batch[3] - 1)
+        self.storage.end_blank_ballots(ballot_names)
+        self.metrics.count('ballots_created', len(ballot_names))
         self.logger.info('END creating blank ballots')
 
+    def rebuild_ballot_pool(self):
+        """rebuilds the index of blank ballots from the stored blank ballots"""
+        self.storage.rebuild_pool()
+
     def pick_random_ballot(self):
         """when a new voter is ready to vote pick a blank ballot at random, return the name and content"""
-        folder = os.path.join(self.workdir, 'blank_ballots')
-        ballot_names = [name for name in os.listdir(folder) if self.re_blank.match(name)]
-        ballot_name = random.choice(ballot_names)
-        source_path = self.get_path(ballot_name)
-        destination_path = self.get_path(ballot_name, 'voting_ballots')
-        shutil.move(source_path, destination_path)
-        with open(destination_path) as fp:
-            serialized_ballot = fp.read()
-            self.verify_integrity(ballot_name, serialized_ballot)
-            ballot = json.loads(serialized_ballot)
-        self.logger.info('picked a random ballot %s' % ballot_name)
+        with self.metrics.timer('pick'):
+            picked = self.storage.claim_blank_ballot()
+        if picked is None:
+            raise EVoteError('No blank ballots available')
+        ballot_name, serialized_ballot = picked
+        self.verify_integrity(ballot_name, serialized_ballot)
+        ballot = json.loads(serialized_ballot)
+        self.logger.debug('picked a random ballot %s', ballot_name)
         return ballot_name, ballot
 
+    @property
+    def candidates(self):
+        """the registered candidates (loaded once)"""
+        if self._candidates is None:
+            self._candidates = self.storage.load_candidates()
+        return self._candidates
+
+    @property
+    def live_tally(self):
+        """the running tally of the cast votes (stored in workdir/live_tally.bin)"""
+        return LiveTally(os.path.join(self.workdir, 'live_tally.bin'), self.candidates)
+
+    @property
+    def public_rsa(self):
+        """HumanRSA loaded with self.public_key_1 (loaded once)"""
+        if self._public_rsa is None:
+            h = HumanRSA()
+            h.load_public_pem(self.public_key_1)
+            self._public_rsa = h
+        return self._public_rsa
+
+    @property
+    def signing_rsa(self):
+        """HumanRSA loaded with self.private_key_2 (loaded once)"""
+        if self._signing_rsa is None:
+            h = HumanRSA()
+            h.load_private_pem(self.private_key_2)
+            self._signing_rsa = h
+        return self._signing_rsa
+
     def encrypt_serialized_ballot(self, serialized_ballot):
-        """encrypts a serialized ballot using RSA self.public_key_1"""
-        self.logger.info('encrypting ballot')
-        h = HumanRSA()
-        h.load_public_pem(self.public_key_1)
-        encrypted_ballot = h.encrypt(serialized_ballot.encode())
+        """encrypts a serialized ballot using RSA self.public_key_1, if self.envelope
+        the ballot is sealed with a new symmetric key and only the key is encrypted with RSA"""
+        self.logger.debug('encrypting ballot')
+        with self.metrics.timer('encrypt'):
+            if self.envelope:
+                key = AESGCM.generate_key(bit_length=256)
+                nonce = os.urandom(NONCE_SIZE)
+                wrapped_key = self.public_rsa.encrypt(key)
+                return (ENVELOPE_MAGIC + struct.pack('>H', len(wrapped_key)) + wrapped_key + nonce +
+                        AESGCM(key).encrypt(nonce, serialized_ballot.encode(), None))
+            encrypted_ballot = self.public_rsa.encrypt(serialized_ballot.encode())
         return encrypted_ballot
 
     def decrypt_serialized_ballot(self, serialized_ballot, private_key_1):
-        """decrypts a ballot using the provided private_key_1"""
-        self.logger.info('decrypting ballot')
-        h = HumanRSA()
-        h.load_private_pem(private_key_1)
-        decrypted_ballot = h.decrypt(serialized_ballot).decode()
-        return decrypted_ballot 
+        """decrypts a ballot using the provided private_key_1 (a PEM or a loaded HumanRSA)
+        both plain RSA and envelope encrypted ballots are supported"""
+        self.logger.debug('decrypting ballot')
+        if isinstance(private_key_1, HumanRSA):
+            h = private_key_1
+        else:
+            h = HumanRSA()
+            h.load_private_pem(private_key_1)
+        with self.metrics.timer('decrypt'):
+            # plain RSA ballots are exactly as long as the key, envelopes are always longer
+            magic = serialized_ballot[:len(ENVELOPE_MAGIC)]
+            if (magic in (ENVELOPE_MAGIC, ENVELOPE_MAGIC_V1) and
+                    len(serialized_ballot) != h.private_key.key_size // 8):
+                start = len(ENVELOPE_MAGIC) + 2
+                size, = struct.unpack('>H', serialized_ballot[len(ENVELOPE_MAGIC):start])
+                key = h.decrypt(serialized_ballot[start:start + size])
+                sealed = serialized_ballot[start + size:]
+                if magic == ENVELOPE_MAGIC_V1:
+                    return HumanAES(key).decrypt(sealed).decode()
+                nonce, sealed = sealed[:NONCE_SIZE], sealed[NONCE_SIZE:]
+                return AESGCM(key).decrypt(nonce, sealed, None).decode()
+            decrypted_ballot = h.decrypt(serialized_ballot).decode()
+        return decrypted_ballot
 
-    def save_voted_ballot(self, ballot):
-        """encrypts and saves a ballot and its signature file"""
+    def seal_ballot(self, ballot):
+        """serializes, encrypts and signs a voted ballot without storing it, returns
+        (ballot_name, serialized_ballot, encrypted_ballot, signature_name, signature)"""
         serialized_ballot = json.dumps(ballot)
         encrypted_ballot = self.encrypt_serialized_ballot(serialized_ballot)
         ballot_hash = self.hash(encrypted_ballot)
         ballot_name = 'ballot.%.6i.encrypted.%s.json' % (ballot['number'], ballot_hash)        
-        self.logger.info('saving encryted voted ballot %s' % ballot_name)
-        new_ballot_path = self.get_path(ballot_name)
-        with open(new_ballot_path, 'wb') as fp:
-            fp.write(encrypted_ballot)
-
         signature_name = 'ballot.%.6i.encrypted.%s.signature' % (ballot['number'], ballot_hash)
-        self.logger.info('saving ballot digital signature %s' % ballot_name)
-        signature_path = os.path.join(self.workdir, 'signatures', signature_name)
-        h = HumanRSA()
-        h.load_private_pem(self.private_key_2)
-        signature = h.sign(encrypted_ballot)
-        with open(signature_path, 'wb') as fp:
-            fp.write(signature)       
+        with self.metrics.timer('sign'):
+            signature = self.signing_rsa.sign(encrypted_ballot)
+        return ballot_name, serialized_ballot, encrypted_ballot, signature_name, signature
+
+    def save_voted_ballot(self, ballot):
+        """encrypts and saves a ballot and its signature file"""
+        ballot_name, serialized_ballot, encrypted_ballot, signature_name, signature = self.seal_ballot(ballot)
+        self.logger.debug('saving encrypted voted ballot %s', ballot_name)
+        self.storage.save_encrypted(ballot_name, encrypted_ballot, signature_name, signature)
+        return ballot_name, serialized_ballot, signature
+
+    def check_preference(self, preference):
+        """checks the preference only contains registered candidates, each at most once"""
+        candidates = set(self.candidates)
+        if len(preference) != len(set(preference)) or not candidates.issuperset(preference):
+            raise EVoteError('Invalid preference')
+
+    def check_vote(self, voter_id, preference):
+        """checks the preference and, without locking, that the voter has not voted yet
+        (claim_ballot checks again with the lock), returns the voter code"""
+        self.check_preference(preference)
+        voter_code = self.hash(voter_id)
+        if self.storage.has_voted(voter_code):
+            raise EVoteError('Voter has voted already')
+        return voter_code
+
+    def claim_ballot(self, voter_code):
+        """the critical section of a vote: flags the voter and picks a random ballot"""
+        # atomically flag the voter, raises EVoteError if not allowed or voted already
+        self.storage.claim_voter(voter_code)
+        try:
+            return self.pick_random_ballot()
+        except Exception:
+            self.storage.release_voter(voter_code)
+            raise
+
+    def record_ballot(self, original_ballot_name, sealed):
+        """stores a sealed ballot and its signature, deletes the blank ballot, returns the receipt"""
+        ballot_name, serialized_ballot, encrypted_ballot, signature_name, signature = sealed
+        self.logger.debug('saving encrypted voted ballot %s', ballot_name)
+        with self.metrics.timer('write'):
+            self.storage.save_encrypted(ballot_name, encrypted_ballot, signature_name, signature)
+            # delete blank ballot
+            self.storage.remove_voting_ballot(original_ballot_name)
         return ballot_name, serialized_ballot, signature
 
+    def abort_vote(self, voter_code, original_ballot_name, sealed=None):
+        """if the vote was not propery recorded - undo everything"""
+        if sealed:
+            self.storage.remove_encrypted(sealed[0], sealed[3])
+        self.storage.release_ballot(original_ballot_name)
+        self.storage.release_voter(voter_code)
 
     def cast_vote(self, voter_id, preference):
         """records a vote:
-        - check voter has not already voted
+        - marks the voter as voted (fails if the voter has already voted)
         - picks a random ballot
         - records the vote
         - stores the encrypted voted ballot
         - stores the signature for the encrypted voted ballot
-        - marks the voter file as voted=True
+        if anything fails the ballot and the voter are restored
         """
-        # get candidates
-        filename = os.path.join(self.workdir, 'candidates.json')
-        with open(filename, 'r') as fp:
-            candidates = json.load(fp)
+        self.check_preference(preference)
         # convert voter_id to votercode
         voter_code = self.hash(voter_id)
-        voter_filename = os.path.join(self.workdir, 'voters', voter_code+'.json')
-        if not os.path.exists(voter_filename):
-            raise EVoteError('Voter is not allowed to vote')
-        # lock the voter information
-        lock = FileLock(voter_filename+'.lock')
-        with lock:
-            # check the user has not voted already
-            with open(voter_filename, 'r') as fp:                    
-                data = fp.read()
-            self.logger.info(voter_filename, repr(data))
-            voter_info = json.loads(data)
-            if voter_info['voted']:
-                self.logger.info('voter has voted already')
-                raise EVoteError('Voter has voted already')
-            # pick a random ballot
-            original_ballot_name, ballot = self.pick_random_ballot()
+        original_ballot_name, ballot = self.claim_ballot(voter_code)
+        sealed = None
+        try:
             # record votes
             ballot['preference'] = preference
-            # save the voted ballot
-            new_ballot_name, serialized_ballot, signature = self.save_voted_ballot(ballot)
-            try:
-                # delete blank ballot
-                os.unlink(self.get_path(original_ballot_name, 'voting_ballots'))
-                # record voter has voted
-                voter_info['voted'] = True
-                with open(voter_filename, 'w') as fp:
-                    json.dump(voter_info, fp)
-                return new_ballot_name, serialized_ballot, signature
-            except EVoteError:
-                raise
-            except Exception as original_exception:
-                try:
-                    voting_ballot_path = self.get_path(original_ballot_name, 'voting_ballots')
-                    blank_ballot_path = self.get_path(original_ballot_name)
-                    voted_ballot_path = self.get_path(new_ballot_name)
-                    # if the vote was not propery recorded - undo everything
-                    if os.path.exists(voting_ballot_path):
-                        shutil.move(voting_ballot_path, blank_ballot_path)
-                        if os.path.exists(voted_ballot_path):
-                            os.unlink(voted_ballot_path)
-                        voter_info['voted'] = False
-                        with open(voter_filename, 'w') as fp:
-                            json.dump(voter_info, fp)                        
-                    raise original_exception
-                except Exception as new_exception:
-                    raise new_exception
-
-    def decrypt_ballots(self, private_key):
-        """decripts all ballots"""
+            sealed = self.seal_ballot(ballot)
+            receipt = self.record_ballot(original_ballot_name, sealed)
+        except Exception:
+            self.abort_vote(voter_code, original_ballot_name, sealed)
+            self.metrics.count('votes_aborted')
+            raise
+        self.metrics.count('votes_cast')
+        if self.live:
+            self.live_tally.add(preference)
+        return receipt
+
+    async def cast_vote_async(self, voter_id, preference, executor=None):
+        """same as cast_vote but for asyncio servers: only the voter flag and the ballot
+        claim are done in the critical section, the blocking I/O and the RSA encryption
+        and signature run in executor (the default executor if None)"""
+        loop = asyncio.get_running_loop()
+        # may load the candidates and the manifest and reads the storage, so not in the loop
+        voter_code = await loop.run_in_executor(executor, self.check_vote, voter_id, preference)
+        original_ballot_name, ballot = await loop.run_in_executor(
+            executor, self.claim_ballot, voter_code)
+        sealed = None
+        try:
+            ballot['preference'] = preference
+            sealed = await loop.run_in_executor(executor, self.seal_ballot, ballot)
+            receipt = await loop.run_in_executor(
+                executor, self.record_ballot, original_ballot_name, sealed)
+        except Exception:
+            await loop.run_in_executor(
+                executor, self.abort_vote, voter_code, original_ballot_name, sealed)
+            self.metrics.count('votes_aborted')
+            raise
+        self.metrics.count('votes_cast')
+        if self.live:
+            await loop.run_in_executor(executor, self.live_tally.add, preference)
+        return receipt
+
+    def decrypt_ballot(self, ballot_name, private_key):
+        """decrypts a single encrypted ballot and saves it, returns the decrypted ballot name"""
+        self.logger.debug('decrypting %s', ballot_name)
+        serialized_encrypted_ballot = self.storage.read_encrypted(ballot_name)
+        self.verify_integrity(ballot_name, serialized_encrypted_ballot)
+        serialized_decrypted_ballot = self.decrypt_serialized_ballot(serialized_encrypted_ballot, private_key)
+        ballot_hash = self.hash(serialized_decrypted_ballot)
+        ballot_number = number_of(ballot_name)
+        ballot_name = 'ballot.%.6i.decrypted.%s.json' % (ballot_number, ballot_hash)
+        self.logger.debug('saving decrypted ballot %s', ballot_name)
+        with self.metrics.timer('write'):
+            self.storage.save_decrypted(ballot_name, serialized_decrypted_ballot)
+        self.metrics.count('ballots_decrypted')
+        return ballot_name
+
+    def decrypt_ballots(self, private_key, workers=None, batch_size=100):
+        """decripts all ballots, in parallel if workers > 1
+        ballots already decrypted (by number) are skipped so the process can be resumed"""
         self.logger.info('BEGIN decrypting ballots')
-        encrypted_ballots_folder = os.path.join(self.workdir, 'encrypted_ballots')
-        ballot_names = [name for name in os.listdir(encrypted_ballots_folder) if self.re_encrypted.match(name)]
-        for ballot_name in ballot_names:
-            self.logger.info('decrypting %s' % ballot_name)
-            encrypted_path = self.get_path(ballot_name)
-            with open(encrypted_path, 'rb') as fp:
-                serialized_encrypted_ballot = fp.read()
-                self.verify_integrity(ballot_name, serialized_encrypted_ballot)
-            serialized_decrypted_ballot = self.decrypt_serialized_ballot(serialized_encrypted_ballot, private_key)
-            ballot_hash = self.hash(serialized_decrypted_ballot)
-            ballot_number = int(ballot_name.split('.')[1])
-            ballot_name = 'ballot.%.6i.decrypted.%s.json' % (ballot_number, ballot_hash)
-            self.logger.info('saving decrypted ballot %s' % ballot_name)
-            decrypted_path = self.get_path(ballot_name)
-            with open(decrypted_path, 'w') as fp:
-                fp.write(serialized_decrypted_ballot)
+        decrypted_numbers = set(number_of(name) for name in self.storage.iter_decrypted_names())
+        ballot_names = [name for name in self.storage.iter_encrypted_names()
+                        if not number_of(name) in decrypted_numbers]
+        if not workers or workers == 1:
+            h = HumanRSA()
+            h.load_private_pem(private_key)
+            for ballot_name in ballot_names:
+                self.decrypt_ballot(ballot_name, h)
+        else:
+            batches = [ballot_names[i:i + batch_size]
+                       for i in range(0, len(ballot_names), batch_size)]
+            initargs = (self.workdir, self.public_key_1, self.private_key_2, self.storage, private_key)
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers, initializer=_init_decrypt_worker, initargs=initargs) as executor:
+                for decrypted_names in executor.map(_decrypt_batch, batches):
+                    # the workers do not share self.metrics, only the count is recorded
+                    self.metrics.count('ballots_decrypted', len(decrypted_names))
+                    self.logger.info('decrypted %i ballots', len(decrypted_names))
         self.logger.info('END decrypting ballots')
 
-    def count_votes(self, alg):
-        """counts all votes stored in the decrypted ballots"""
-        self.logger.info('BEGIN counting votes')
-        decrypted_ballots_folder = os.path.join(self.workdir, 'decrypted_ballots')
-        ballot_names = [name for name in os.listdir(decrypted_ballots_folder) if self.re_decrypted.match(name)]
-        preferences = []
-        for ballot_name in ballot_names:
-            self.logger.info('counting balot %s' % ballot_name)
-            decrypted_path = self.get_path(ballot_name)
-            with open(decrypted_path) as fp:
-                serialized_decrypted_ballot = fp.read()
+    def audit(self, public_key_2, workers=None, batch_size=100, cache_path=None):
+        """verifies the published election and returns a report, the election is
+        sound if report['errors'] is empty. It checks that:
+        - every encrypted ballot matches the hash in its name and has a valid signature
+        - every decrypted ballot matches the hash in its name and has an encrypted ballot
+        - ballot numbers (from the lowest one, create_ballots may start anywhere)
+          have no gaps and no duplicates
+        - the number of voters who voted matches the number of encrypted ballots
+        Signatures are verified in batches, in parallel if workers > 1. If cache_path is given
+        the results are cached there (by content hash, for this public_key_2 and digest)
+        so a re-audit only verifies new ballots"""
+        self.logger.info('BEGIN auditing election')
+        errors = []
+        # the cache is only valid for the same verification key and digest
+        fingerprint = {'public_key_2': self.hash(public_key_2), 'digest': self.digest}
+        cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as fp:
+                data = json.load(fp)
+            if isinstance(data, dict) and data.get('fingerprint') == fingerprint:
+                cache = data['signatures']
+        numbers = collections.Counter()
+        for name in self.storage.iter_blank_names():
+            numbers[number_of(name)] += 1
+        for name in self.storage.iter_voting_names():
+            numbers[number_of(name)] += 1
+        # encrypted ballots and their signatures
+        signature_names = set(self.storage.iter_signature_names())
+        encrypted_numbers = set()
+        def iter_pending():
+            """yields the batches of (key, name, data, signature) to verify"""
+            batch = []
+            for name in self.storage.iter_encrypted_names():
+                numbers[number_of(name)] += 1
+                encrypted_numbers.add(number_of(name))
+                data = self.storage.read_encrypted(name)
+                data_hash = self.hash(data)
+                if data_hash != name.split('.')[3]:
+                    errors.append('%s does not match its hash' % name)
+                signature_name = name[:-len('.json')] + '.signature'
+                if not signature_name in signature_names:
+                    errors.append('%s has no signature' % name)
+                    continue
+                signature_names.discard(signature_name)
+                signature = self.storage.read_signature(signature_name)
+                key = data_hash + ':' + self.hash(signature)
+                if not key in cache:
+                    batch.append((key, name, bytes(data), signature))
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+                elif not cache[key]:
+                    errors.append('%s has an invalid signature' % name)
+            if batch:
+                yield batch
+        verified = []
+        def record(results):
+            verified.extend(results)
+            for key, name, valid in results:
+                cache[key] = valid
+                if not valid:
+                    errors.append('%s has an invalid signature' % name)
+        if not workers or workers == 1:
+            _init_audit_worker(public_key_2)
+            for batch in iter_pending():
+                record(_verify_batch(batch))
+        else:
+            # at most two batches per worker are read and waiting to be verified
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers, initializer=_init_audit_worker, initargs=(public_key_2,)) as executor:
+                futures = collections.deque()
+                for batch in iter_pending():
+                    futures.append(executor.submit(_verify_batch, batch))
+                    if len(futures) >= 2 * workers:
+                        record(futures.popleft().result())
+                while futures:
+                    record(futures.popleft().result())
+        self.logger.info('verified %i new signatures', len(verified))
+        for signature_name in sorted(signature_names):
+            errors.append('%s has no encrypted ballot' % signature_name)
+        if cache_path:
+            with open(cache_path, 'w') as fp:
+                json.dump({'fingerprint': fingerprint, 'signatures': cache}, fp)
+        # decrypted ballots
+        decrypted_numbers = set()
+        for name, data in self.storage.iter_decrypted():
+            number = number_of(name)
+            if self.hash(data) != name.split('.')[3]:
+                errors.append('%s does not match its hash' % name)
+            elif json.loads(data).get('number') != number:
+                errors.append('%s does not match its number' % name)
+            if number in decrypted_numbers or not number in encrypted_numbers:
+                errors.append('%s has no matching encrypted ballot' % name)
+            decrypted_numbers.add(number)
+        if decrypted_numbers and decrypted_numbers != encrypted_numbers:
+            errors.append('%i encrypted ballots were not decrypted'
+                          % len(encrypted_numbers - decrypted_numbers))
+        # ballot numbering
+        for number, count in sorted(numbers.items()):
+            if count > 1:
+                errors.append('ballot number %.6i is duplicated' % number)
+        if numbers:
+            missing = set(range(min(numbers), max(numbers) + 1)) - set(numbers)
+            for number in sorted(missing):
+                errors.append('ballot number %.6i is missing' % number)
+        # voters
+        voted = sum(1 for voter_code, has_voted in self.storage.iter_voters() if has_voted)
+        if voted != len(encrypted_numbers):
+            errors.append('%i voters voted but there are %i encrypted ballots'
+                          % (voted, len(encrypted_numbers)))
+        self.logger.info('END auditing election')
+        return {'ballots': len(numbers),
+                'encrypted': len(encrypted_numbers),
+                'decrypted': len(decrypted_numbers),
+                'voted': voted,
+                'verified': len(verified),
+                'errors': errors}
+
+    def export(self, folder, packed=False):
+        """writes the election in the public folder layout (for publication), if packed
+        each folder is written as a single indexed archive (see ArchiveStorage)"""
+        self.logger.info('BEGIN exporting election to %s', folder)
+        if packed:
+            ArchiveStorage(folder).pack(self.storage)
+            self.logger.info('END exporting election')
+            return
+        target = FolderStorage(folder)
+        target.setup()
+        target.save_manifest(self.manifest)
+        target.save_candidates(self.storage.load_candidates())
+        for voter_code, voted in self.storage.iter_voters():
+            target.add_voter(voter_code, voted)
+        target.add_blank_ballots(self.storage.iter_blank())
+        for name in self.storage.iter_encrypted_names():
+            signature_name = name[:-len('.json')] + '.signature'
+            target.save_encrypted(name, self.storage.read_encrypted(name),
+                                  signature_name, self.storage.read_signature(signature_name))
+        for name, data in self.storage.iter_decrypted():
+            target.save_decrypted(name, data)
+        self.logger.info('END exporting election')
+
+    def iter_preferences(self, ballot_names=None):
+        """yields the preference of each decrypted ballot as it is read
+        (only of the given decrypted ballots if ballot_names is not None)"""
+        if ballot_names is None:
+            items = self.storage.iter_decrypted()
+        else:
+            items = ((name, self.storage.read_decrypted(name)) for name in ballot_names)
+        for ballot_name, serialized_decrypted_ballot in items:
+            self.logger.debug('counting ballot %s', ballot_name)
             self.verify_integrity(ballot_name, serialized_decrypted_ballot)
             data = json.loads(serialized_decrypted_ballot)
-            preference = data['preference']
-            preferences.append(preference)
+            yield data['preference']
+
+    def count_votes(self, alg, stream=False):
+        """counts all votes stored in the decrypted ballots
+        identical preferences are grouped in a BallotProfile as ballots are read,
+        if stream=True alg is given an iterator over the preferences instead"""
+        self.logger.info('BEGIN counting votes')
+        if stream:
+            results = alg(self.iter_preferences())
+        else:
+            results = alg(BallotProfile(self.iter_preferences()))
+        self.logger.info('END counting votes')
+        return results
+
+    def check_live_tally(self):
+        """recounts the decrypted ballots and checks the running tally matches them"""
+        self.logger.info('BEGIN checking live tally')
+        recount = LiveTally(None, self.candidates)
+        for preference, count in BallotProfile(self.iter_preferences()).items():
+            recount.add(preference, count)
+        matches = recount == self.live_tally
+        self.logger.info('END checking live tally')
+        return matches
+
+    def count_partial(self, shard=0, shards=1, ballot_names=None, workers=None, batch_size=10000,
+                      rankings=True):
+        """counts the decrypted ballots of one shard into a PartialTally, ballots are split in
+        shards by number (ballot number % shards == shard) so independent counting nodes
+        need no coordination, PartialTally.merge combines their tallies. Alternatively
+        ballot_names selects the ballots. If workers > 1 the shard is counted in parallel"""
+        if not 0 <= shard < shards:
+            raise ValueError('Invalid shard %s of %s (0 <= shard < shards)' % (shard, shards))
+        self.logger.info('BEGIN counting shard %i of %i', shard, shards)
+        if ballot_names is None and shards > 1:
+            ballot_names = [name for name in self.storage.iter_decrypted_names()
+                            if number_of(name) % shards == shard]
+        tally = PartialTally(self.candidates, rankings=rankings, shard=shard, shards=shards)
+        if not workers or workers == 1:
+            for preference, count in BallotProfile(self.iter_preferences(ballot_names)).items():
+                tally.add(preference, count)
+        else:
+            if ballot_names is None:
+                ballot_names = list(self.storage.iter_decrypted_names())
+            batches = [(self.workdir, self.storage, ballot_names[i:i + batch_size], rankings)
+                       for i in range(0, len(ballot_names), batch_size)]
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                for data in executor.map(_count_batch, *zip(*batches)):
+                    tally.add_counts(PartialTally.from_dict(data))
+        self.logger.info('END counting shard %i of %i', shard, shards)
+        return tally
+
+    def count_votes_multi(self, algorithms):
+        """counts all votes with every algorithm in algorithms (a list) reading the
+        decrypted ballots once, returns the list of results (see rank_all)"""
+        self.logger.info('BEGIN counting votes')
+        results = rank_all(BallotProfile(self.iter_preferences()), algorithms)
         self.logger.info('END counting votes')
-        return alg(preferences)
+        return results
@@ -22,7 +22,8 @@ setup(
     maintainer_email='massimo.dipierro@gmail.com',
     description='The EVote Ranking algorithms',
     long_description=__doc__,
-    packages=[],
+    packages=['evote_ranking'],
+    entry_points={'console_scripts': ['evote-count = evote_ranking.__main__:main']},
     include_package_data=True,
     zip_safe=False,
     platforms='any',
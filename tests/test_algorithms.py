@@ -1,5 +1,13 @@
-from unittest import TestCase
-from evote_ranking import (simple_majority, instant_runoff, borda, schulze)
+import random
+import functools
+import contextlib
+from unittest import TestCase, mock
+from evote_ranking import (simple_majority, instant_runoff, borda, schulze, rank_all,
+                          BallotProfile)
+from evote_ranking.live import LiveTally
+from evote_ranking.tally import PartialTally
+from evote_ranking.algorithms import borda_weights
+from fractions import Fraction
 
 
 class EvoteTest(TestCase):
@@ -27,6 +35,15 @@ class EvoteTest(TestCase):
         expected = [(45, 'A'), (19, 'C'), (8, 'E'), (8, 'B'), (7, 'D')]
         self.assertEqual(results, expected)
 
+    def test_instant_runoff_trace(self):
+        results, rounds = instant_runoff(self.preferences, trace=True)
+        self.assertEqual(results, instant_runoff(self.preferences))
+        self.assertEqual(len(rounds), 4)
+        self.assertEqual(rounds[0]['tally'], {'A': 10, 'C': 12, 'B': 8, 'E': 8, 'D': 7})
+        self.assertEqual(rounds[0]['eliminated'], ['D'])
+        self.assertEqual(rounds[1]['eliminated'], ['B', 'E'])
+        self.assertEqual(rounds[-1], {'round': 4, 'tally': {'A': 45}, 'eliminated': ['A']})
+
     def test_borda(self):
         results = borda(self.preferences)
         print(results)
@@ -37,3 +54,106 @@ class EvoteTest(TestCase):
         results= schulze(self.preferences)
         expected = [(4, 'E'), (3, 'A'), (2, 'C'), (1, 'B'), (0, 'D')]
         self.assertEqual(results, expected)
+
+    def test_schulze_array_fallback(self):
+        with mock.patch('evote_ranking.algorithms.numpy', None):
+            results = schulze(self.preferences)
+        expected = [(4, 'E'), (3, 'A'), (2, 'C'), (1, 'B'), (0, 'D')]
+        self.assertEqual(results, expected)
+
+    def test_schulze_engines_agree(self):
+        random.seed(1)
+        candidates = ['C%i' % i for i in range(12)]
+        preferences = [random.sample(candidates, 12) for i in range(300)]
+        results = schulze(preferences)
+        with mock.patch('evote_ranking.algorithms.numpy', None):
+            self.assertEqual(schulze(preferences), results)
+
+    def test_ballot_profile(self):
+        profile = BallotProfile(self.preferences)
+        self.assertEqual(len(profile.keys()), 8)
+        self.assertEqual(profile.total, 45)
+        self.assertEqual(len(profile), 45)
+        for alg in (simple_majority, instant_runoff, borda, schulze):
+            self.assertEqual(alg(profile), alg(self.preferences))
+        # an algorithm looping over the preferences sees every ballot
+        def last_choices(preferences):
+            votes = {}
+            for preference in preferences:
+                votes[preference[-1]] = votes.get(preference[-1], 0) + 1
+            return sorted((v, k) for k, v in votes.items())
+        self.assertEqual(last_choices(profile), last_choices(self.preferences))
+        self.assertEqual(sorted(profile), sorted(map(tuple, self.preferences)))
+
+    def test_rank_all(self):
+        algorithms = [simple_majority, instant_runoff, borda,
+                      functools.partial(borda, mode='exponential'), schulze]
+        results = rank_all((preference for preference in self.preferences), algorithms)
+        self.assertEqual(results, [alg(self.preferences) for alg in algorithms])
+        # the intermediate structures are computed once and dropped if the profile changes
+        profile = BallotProfile(self.preferences)
+        rank_all(profile, algorithms)
+        self.assertEqual(sorted(key if isinstance(key, str) else key[0] for key in profile.cache),
+                         ['first_choices', 'pairwise', 'position_counts'])
+        profile.add('ABCDE')
+        self.assertEqual(profile.cache, {})
+
+    def test_borda_modes(self):
+        fractional = borda(self.preferences, mode='fractional')
+        exact = borda(self.preferences, mode='fractional', exact=True)
+        self.assertEqual([k for v, k in exact], [k for v, k in fractional])
+        self.assertEqual(exact[0], (Fraction(449, 20), 'C'))
+        for (v, k), (w, h) in zip(exact, fractional):
+            self.assertAlmostEqual(float(v), w)
+        # exact scores of disjoint sets of ballots add up to the exact score of all ballots
+        half = len(self.preferences) // 2
+        parts = [dict((k, v) for v, k in borda(part, mode='fractional', exact=True))
+                 for part in (self.preferences[:half], self.preferences[half:])]
+        self.assertEqual(dict((k, v) for v, k in exact),
+                         dict((k, parts[0].get(k, 0) + parts[1].get(k, 0)) for v, k in exact))
+        self.assertEqual(borda(self.preferences, mode='exponential')[0], (9041, 'C'))
+        self.assertEqual(borda_weights('exponential', 5), (625, 125, 25, 5, 1))
+        self.assertEqual(borda_weights('fractional', 4, scale=12), (12, 6, 4, 3))
+        with self.assertRaises(RuntimeError):
+            borda(self.preferences, mode='quadratic')
+
+    def test_live_tally(self):
+        live = LiveTally(None, 'ABCDE')
+        for preference in self.preferences:
+            live.add(preference)
+        self.assertEqual(live.total, 45)
+        self.assertEqual(live.simple_majority(), simple_majority(self.preferences))
+        self.assertEqual(live.borda(), borda(self.preferences))
+        self.assertEqual(live.schulze(), schulze(self.preferences))
+
+    def test_tallies_agree_with_algorithms(self):
+        # small random elections have many ties and partial ballots
+        for engine in ('numpy', 'array'):
+            with mock.patch('evote_ranking.algorithms.numpy', None) if engine == 'array' else contextlib.nullcontext():
+                for seed in range(100):
+                    rng = random.Random(seed)
+                    preferences = [rng.sample('ABCD', rng.choice([4, 4, 3])) for k in range(rng.randint(1, 8))]
+                    tally = PartialTally(['D', 'C', 'B', 'A'])
+                    for preference in preferences:
+                        tally.add(preference)
+                    self.assertEqual(tally.schulze(), schulze(preferences))
+                    self.assertEqual(tally.borda(), borda(preferences))
+                    self.assertEqual(tally.instant_runoff(), instant_runoff(preferences))
+
+    def test_live_tally_partial_ballots(self):
+        preferences = [['Tim'], ['John', 'Tim']]
+        live = LiveTally(None, ['Tim', 'John', 'Matt'])
+        for preference in preferences:
+            live.add(preference)
+        self.assertEqual(borda(preferences), [(3, 'Tim'), (2, 'John')])
+        for mode in ('linear', 'fractional', 'exponential'):
+            self.assertEqual(live.borda(mode), borda(preferences, mode))
+            self.assertEqual(live.borda(mode), borda(BallotProfile(preferences), mode))
+        self.assertEqual(live.simple_majority(), simple_majority(preferences))
+        # the result does not depend on the order of the ballots
+        self.assertEqual(borda(preferences[::-1]), borda(preferences))
+
+    def test_stream(self):
+        for alg in (simple_majority, instant_runoff, borda, schulze):
+            stream = (preference for preference in self.preferences)
+            self.assertEqual(alg(stream), alg(self.preferences))
@@ -0,0 +1,31 @@
+import os
+import tempfile
+from unittest import TestCase
+from evote_ranking.archive import Archive, write_archive
+
+
+class ArchiveTest(TestCase):
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'test.pack')
+            items = [('ballot.%.6i' % k, ('{"number": %i}' % k) * k) for k in range(20, 0, -1)]
+            names = write_archive(path, items)
+            self.assertEqual(names, sorted(name for name, _ in items))
+            with Archive(path) as archive:
+                self.assertEqual(len(archive), 20)
+                self.assertEqual(archive.names(), names)
+                for name, data in items:
+                    self.assertEqual(bytes(archive[name]).decode(), data)
+                self.assertNotIn('ballot.000000', archive)
+                self.assertEqual(archive.get('ballot.000021'), None)
+                self.assertRaises(KeyError, lambda: archive['missing'])
+                self.assertEqual([name for name, _ in archive.items()], names)
+
+    def test_empty_archive(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'test.pack')
+            write_archive(path, [])
+            with Archive(path) as archive:
+                self.assertEqual(archive.names(), [])
+                self.assertNotIn('x', archive)
@@ -0,0 +1,24 @@
+import os
+import io
+import contextlib
+import importlib.util
+from unittest import TestCase
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+
+def load_benchmark(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BENCHMARKS, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class BenchmarksTest(TestCase):
+
+    def test_bench_schulze(self):
+        # the engines are compared on every run, a mismatch raises RuntimeError
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            load_benchmark('bench_schulze').main(50)
+        self.assertEqual(len(output.getvalue().splitlines()), 5)
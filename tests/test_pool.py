@@ -0,0 +1,46 @@
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from evote_ranking.pool import BallotPool
+
+
+class BallotPoolTest(TestCase):
+
+    def test_claim(self):
+        with tempfile.TemporaryDirectory() as folder:
+            pool = BallotPool(os.path.join(folder, 'pool.index'))
+            pool.rebuild(['ballot.%.6i' % k for k in range(10)])
+            pool.add(['ballot.%.6i' % k for k in range(10, 20)])
+            self.assertEqual(len(pool), 20)
+            claimed = [pool.claim(lambda name: True) for k in range(20)]
+            self.assertEqual(sorted(claimed), ['ballot.%.6i' % k for k in range(20)])
+            self.assertEqual(pool.claim(lambda name: True), None)
+
+    def test_stale_and_wide_names(self):
+        with tempfile.TemporaryDirectory() as folder:
+            pool = BallotPool(os.path.join(folder, 'pool.index'))
+            pool.rebuild(['a', 'b'])
+            pool.add(['x' * 100])
+            self.assertEqual(sorted(pool.names()), ['a', 'b', 'x' * 100])
+            # entries which cannot be taken are dropped
+            self.assertEqual(pool.claim(lambda name: name == 'b'), 'b')
+            self.assertNotIn('b', pool.names())
+            self.assertEqual(pool.claim(lambda name: False), None)
+            self.assertEqual(pool.names(), [])
+
+    def test_concurrent_claims(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'pool.index')
+            BallotPool(path).rebuild([str(k) for k in range(200)])
+            claimed = []
+            def worker():
+                pool = BallotPool(path)
+                for k in range(50):
+                    claimed.append(pool.claim(lambda name: True))
+            threads = [threading.Thread(target=worker) for k in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(claimed, key=int), [str(k) for k in range(200)])
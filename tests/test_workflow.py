@@ -1,15 +1,56 @@
 import os
 import uuid
+import asyncio
 import random
 import random
+import shutil
 import tempfile
+import threading
+import struct
+import io
+import json
+import contextlib
+import urllib.request
+from unittest import mock
 from unittest import TestCase
 from evote_ranking import (simple_majority, instant_runoff, borda, schulze, Workflow)
-from evote_ranking.workflow import EVoteError
-from human_security import HumanRSA
+from evote_ranking.workflow import EVoteError, ENVELOPE_MAGIC
+from evote_ranking.storage import FolderStorage, SQLiteStorage, ArchiveStorage
+from evote_ranking.metrics import InMemoryMetrics
+from evote_ranking.tally import PartialTally
+from evote_ranking.__main__ import main
+from human_security import HumanAES, HumanRSA
+
+def make_keys():
+    h1 = HumanRSA()
+    h1.generate()
+    h2 = HumanRSA()
+    h2.generate()
+    return h1.public_pem(), h1.private_pem(), h2.public_pem(), h2.private_pem()
+
+
+def make_election(folder, keys, voters=10, votes=9, candidates=('Tim', 'John', 'Matt'), storage=None,
+                  digest=None, live=False, metrics=None):
+    public_pem_1, private_pem_1, public_pem_2, private_pem_2 = keys
+    os.makedirs(folder, exist_ok=True)
+    workflow = Workflow(folder, public_pem_1, private_pem_2, storage=storage, digest=digest, live=live,
+                        metrics=metrics)
+    workflow.setup()
+    workflow.create_ballots(voters)
+    workflow.register_candidates(list(candidates))
+    for k in range(voters):
+        workflow.register_voter('voter-%i' % k)
+    for k in range(votes):
+        workflow.cast_vote('voter-%i' % k, random.sample(candidates, len(candidates)))
+    return workflow
+
 
 class EvoteWorkflowTest(TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = make_keys()
+
     def test_workflow(self):
 
         h1 = HumanRSA()
@@ -45,3 +86,437 @@ class EvoteWorkflowTest(TestCase):
             self.assertEqual(len(os.listdir(os.path.join(folder, 'blank_ballots'))), 1)
             self.assertEqual(len(os.listdir(os.path.join(folder, 'encrypted_ballots'))), 9)
             self.assertEqual(len(os.listdir(os.path.join(folder, 'decrypted_ballots'))), 9)
+
+    def test_count_votes_stream(self):
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(1)
+            workflow = make_election(folder, self.keys, 10, 9)
+            workflow.decrypt_ballots(self.keys[1])
+            for alg in (simple_majority, instant_runoff, borda, schulze):
+                self.assertEqual(workflow.count_votes(alg, stream=True), workflow.count_votes(alg))
+
+    def test_count_votes_multi(self):
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(1)
+            workflow = make_election(folder, self.keys, 10, 9)
+            workflow.decrypt_ballots(self.keys[1])
+            algorithms = [simple_majority, instant_runoff, borda, schulze]
+            self.assertEqual(workflow.count_votes_multi(algorithms),
+                             [workflow.count_votes(alg) for alg in algorithms])
+
+    def test_parallel_decrypt(self):
+        private_pem_1 = self.keys[1]
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(2)
+            workflow = make_election(os.path.join(folder, 'a'), self.keys, 12, 12)
+            shutil.copytree(workflow.workdir, os.path.join(folder, 'b'))
+            workflow.decrypt_ballots(private_pem_1)
+            expected = sorted(os.listdir(os.path.join(folder, 'a', 'decrypted_ballots')))
+            self.assertEqual(len(expected), 12)
+            other = Workflow(os.path.join(folder, 'b'), self.keys[0], self.keys[3])
+            other.decrypt_ballots(private_pem_1, workers=2, batch_size=5)
+            decrypted_folder = os.path.join(folder, 'b', 'decrypted_ballots')
+            self.assertEqual(sorted(os.listdir(decrypted_folder)), expected)
+            # resume after losing some of the decrypted ballots
+            for name in expected[:4]:
+                os.unlink(os.path.join(decrypted_folder, name))
+            other.decrypt_ballots(private_pem_1, workers=2)
+            self.assertEqual(sorted(os.listdir(decrypted_folder)), expected)
+            for name in expected:
+                with open(os.path.join(folder, 'a', 'decrypted_ballots', name), 'rb') as fp:
+                    data = fp.read()
+                with open(os.path.join(decrypted_folder, name), 'rb') as fp:
+                    self.assertEqual(fp.read(), data)
+
+    def test_audit(self):
+        public_pem_2 = self.keys[2]
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(3)
+            workflow = make_election(os.path.join(folder, 'election'), self.keys, 10, 8)
+            workflow.decrypt_ballots(self.keys[1])
+            cache_path = os.path.join(folder, 'audit_cache.json')
+            report = workflow.audit(public_pem_2, workers=2, batch_size=3, cache_path=cache_path)
+            self.assertEqual(report['errors'], [])
+            self.assertEqual((report['ballots'], report['encrypted'], report['decrypted'],
+                              report['voted'], report['verified']), (10, 8, 8, 8, 8))
+            # nothing is written in the election folder without a cache_path
+            self.assertFalse(os.path.exists(os.path.join(folder, 'election', 'audit_cache.json')))
+            # the cache is not used with another key
+            other_public_pem = make_keys()[2]
+            report = workflow.audit(other_public_pem, cache_path=cache_path)
+            self.assertEqual(report['verified'], 8)
+            self.assertEqual(len(report['errors']), 8)
+            # a re-audit only verifies new ballots
+            workflow.audit(public_pem_2, cache_path=cache_path)
+            workflow.cast_vote('voter-8', ['Tim', 'John', 'Matt'])
+            report = workflow.audit(public_pem_2, cache_path=cache_path)
+            self.assertEqual(report['verified'], 1)
+            self.assertEqual(report['errors'], ['1 encrypted ballots were not decrypted'])
+            # tampering is detected
+            signatures = os.path.join(folder, 'election', 'signatures')
+            names = sorted(os.listdir(signatures))
+            with open(os.path.join(signatures, names[0]), 'w') as fp:
+                fp.write('00' * 256)
+            with open(os.path.join(signatures, names[1]), 'w') as fp:
+                fp.write('zz-not-hex')
+            blank = os.listdir(os.path.join(folder, 'election', 'blank_ballots'))[0]
+            os.unlink(os.path.join(folder, 'election', 'blank_ballots', blank))
+            for workers in (1, 2):
+                errors = workflow.audit(public_pem_2, workers=workers)['errors']
+                for name in names[:2]:
+                    self.assertIn('%s has an invalid signature' % name.replace('.signature', '.json'), errors)
+                self.assertIn('ballot number %s is missing' % blank.split('.')[1], errors)
+
+    def test_audit_ballot_numbers(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.setup()
+            workflow.create_ballots(3, start=101)
+            self.assertEqual(workflow.audit(public_pem_2)['errors'], [])
+            workflow.create_ballots(2, start=105)
+            self.assertEqual(workflow.audit(public_pem_2)['errors'], ['ballot number 000104 is missing'])
+
+    def test_bulk_create_ballots(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(4)
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.setup()
+            workflow.create_ballots(10, workers=2, batch_size=3)
+            workflow.create_ballots(10, start=11, batch_size=4, packed=True)
+            blank_folder = os.path.join(folder, 'blank_ballots')
+            names = os.listdir(blank_folder)
+            self.assertEqual(len([name for name in names if name.endswith('.json')]), 10)
+            self.assertEqual(len([name for name in names if name.endswith('.pack')]), 3)
+            self.assertEqual(len(workflow.storage.pool), 20)
+            expected = sorted(workflow.storage.pool.names())
+            workflow.rebuild_ballot_pool()
+            self.assertEqual(sorted(workflow.storage.pool.names()), expected)
+            workflow.register_candidates(['Tim', 'John'])
+            for k in range(20):
+                workflow.register_voter('voter-%i' % k)
+                workflow.cast_vote('voter-%i' % k, ['Tim', 'John'])
+            self.assertEqual(len(workflow.storage.pool), 0)
+            workflow.rebuild_ballot_pool()
+            self.assertEqual(len(workflow.storage.pool), 0)
+            workflow.decrypt_ballots(private_pem_1)
+            numbers = sorted(int(name.split('.')[1]) for name in
+                             os.listdir(os.path.join(folder, 'decrypted_ballots')))
+            self.assertEqual(numbers, list(range(1, 21)))
+            self.assertEqual(workflow.audit(public_pem_2)['errors'], [])
+
+    def test_packed_ballot_lookup(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.setup()
+            workflow.create_ballots(10, batch_size=4, packed=True)
+            names = sorted(workflow.storage.pool.names())
+            storage = FolderStorage(folder)
+            with mock.patch('evote_ranking.storage.os.listdir', wraps=os.listdir) as listdir:
+                for name in names:
+                    self.assertEqual(json.loads(storage.read_packed_ballot(name))['number'],
+                                     int(name.split('.')[1]))
+                # the archives are listed once and picked by the range in their name
+                self.assertEqual(listdir.call_count, 1)
+                self.assertIsNone(storage.find_pack(11))
+                workflow.create_ballots(2, start=11, packed=True)
+                self.assertIsNotNone(storage.read_packed_ballot(sorted(workflow.storage.pool.names())[-1]))
+                self.assertIsNone(storage.read_packed_ballot('ballot.000099.blank.x.json'))
+
+    def test_missing_ballot_index(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.setup()
+            workflow.create_ballots(5)
+            # an election created before the index existed
+            os.unlink(os.path.join(folder, 'blank_ballots.index'))
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.create_ballots(5, start=6)
+            self.assertEqual(len(workflow.storage.pool), 10)
+            workflow.register_candidates(['Tim', 'John'])
+            for k in range(10):
+                workflow.register_voter('voter-%i' % k)
+                workflow.cast_vote('voter-%i' % k, ['Tim', 'John'])
+            self.assertEqual(len(workflow.storage.pool), 0)
+
+    def test_sqlite_storage(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(5)
+            storage = SQLiteStorage(os.path.join(folder, 'election.db'))
+            workflow = make_election(folder, self.keys, 10, 9, storage=storage)
+            self.assertRaises(EVoteError, lambda: workflow.cast_vote('voter-0', ['Tim']))
+            self.assertRaises(EVoteError, lambda: workflow.cast_vote('unknown', ['Tim']))
+            workflow.decrypt_ballots(private_pem_1, workers=2, batch_size=4)
+            results = workflow.count_votes(instant_runoff)
+            self.assertEqual(sorted(voted for code, voted in storage.iter_voters()), [False] + [True] * 9)
+            self.assertEqual(workflow.audit(public_pem_2)['errors'], [])
+            # export the public folder layout and recount from it
+            export_folder = os.path.join(folder, 'public')
+            os.mkdir(export_folder)
+            workflow.export(export_folder)
+            exported = Workflow(export_folder, public_pem_1, private_pem_2)
+            self.assertEqual(exported.count_votes(instant_runoff), results)
+            self.assertEqual(exported.audit(public_pem_2)['errors'], [])
+            self.assertEqual(len(os.listdir(os.path.join(export_folder, 'blank_ballots'))), 1)
+
+    def test_cast_vote_rollback(self):
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_election(folder, self.keys, 2, 0)
+            def fail(*args):
+                raise IOError('disk full')
+            workflow.storage.save_encrypted = fail
+            self.assertRaises(IOError, lambda: workflow.cast_vote('voter-0', ['Tim']))
+            self.assertEqual(len(workflow.storage.pool), 2)
+            self.assertEqual(os.listdir(os.path.join(folder, 'voting_ballots')), [])
+            del workflow.storage.save_encrypted
+            workflow.cast_vote('voter-0', ['Tim'])
+            self.assertEqual(len(workflow.storage.pool), 1)
+
+    def test_register_voters(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.setup()
+            workflow.create_ballots(4)
+            workflow.register_candidates(['Tim'])
+            filename = os.path.join(folder, 'voter_ids.txt')
+            with open(filename, 'w') as fp:
+                fp.write('voter-0\nvoter-1\nvoter-2\n')
+            with open(filename) as fp:
+                self.assertEqual(workflow.register_voters(fp), 3)
+            voter_code = workflow.hash('voter-0')
+            self.assertTrue(os.path.exists(
+                os.path.join(folder, 'voters', voter_code[:3], voter_code + '.json')))
+            # a voter registered in the old flat layout
+            with open(os.path.join(folder, 'voters', workflow.hash('voter-3') + '.json'), 'w') as fp:
+                fp.write('{"voter_code": "%s", "voted": false}' % workflow.hash('voter-3'))
+            workflow.cast_vote('voter-3', ['Tim'])
+            workflow.cast_vote('voter-0', ['Tim'])
+            self.assertEqual(workflow.migrate_voters(), 1)
+            self.assertRaises(EVoteError, lambda: workflow.cast_vote('voter-3', ['Tim']))
+            voters = sorted(workflow.storage.iter_voters())
+            self.assertEqual([voted for code, voted in voters].count(True), 2)
+            self.assertEqual(len(voters), 4)
+            self.assertEqual([name for name in os.listdir(os.path.join(folder, 'voters'))
+                              if not os.path.isdir(os.path.join(folder, 'voters', name))], [])
+
+    def test_cast_vote_async(self):
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_election(folder, self.keys, 20, 0)
+            async def vote():
+                votes = [workflow.cast_vote_async('voter-%i' % k, ['Tim', 'Matt'])
+                         for k in range(20)]
+                return await asyncio.gather(*votes, return_exceptions=True)
+            receipts = asyncio.run(vote())
+            self.assertEqual(len(set(receipt[0] for receipt in receipts)), 20)
+            async def vote_again():
+                await workflow.cast_vote_async('voter-3', ['Tim'])
+            self.assertRaises(EVoteError, lambda: asyncio.run(vote_again()))
+            self.assertRaises(EVoteError, lambda: workflow.cast_vote('voter-3', ['Bob']))
+            self.assertEqual(len(os.listdir(os.path.join(folder, 'encrypted_ballots'))), 20)
+            self.assertEqual(workflow.audit(self.keys[2])['errors'], [])
+            # loading the candidates and checking the voter do not block the event loop
+            workflow = Workflow(folder, self.keys[0], self.keys[3])
+            threads = []
+            def record(method):
+                def wrapper(*args):
+                    threads.append(threading.current_thread())
+                    return method(*args)
+                return wrapper
+            workflow.storage.load_candidates = record(workflow.storage.load_candidates)
+            workflow.storage.has_voted = record(workflow.storage.has_voted)
+            workflow.storage.load_manifest = record(workflow.storage.load_manifest)
+            self.assertRaises(EVoteError, lambda: asyncio.run(vote_again()))
+            self.assertEqual(len(threads), 3)
+            self.assertNotIn(threading.main_thread(), threads)
+
+    def test_envelope_encryption(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = Workflow(folder, public_pem_1, private_pem_2)
+            workflow.setup()
+            # the metadata is too large to be encrypted with RSA alone
+            workflow.create_ballots(4, metadata={'election': 'x' * 500})
+            workflow.register_candidates(['Tim', 'Matt'])
+            workflow.register_voters('voter-%i' % k for k in range(4))
+            self.assertRaises(ValueError, lambda: workflow.cast_vote('voter-0', ['Tim']))
+            workflow.envelope = True
+            receipts = [workflow.cast_vote('voter-%i' % k, ['Tim', 'Matt']) for k in range(3)]
+            self.assertEqual(workflow.audit(public_pem_2)['errors'], [])
+            workflow.decrypt_ballots(private_pem_1)
+            self.assertEqual(workflow.count_votes(simple_majority), [(3, 'Tim')])
+            for name, serialized_ballot, signature in receipts:
+                decrypted = [data for _, data in workflow.storage.iter_decrypted()]
+                self.assertIn(serialized_ballot, decrypted)
+
+    def test_envelope_has_no_timestamp(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = Workflow(folder, public_pem_1, private_pem_2, envelope=True)
+            serialized_ballot = json.dumps({'number': 1, 'preference': ['Tim']})
+            now = 4102444800
+            with mock.patch('time.time', return_value=now):
+                envelope = workflow.encrypt_serialized_ballot(serialized_ballot)
+            self.assertNotIn(struct.pack('>Q', now), envelope)
+            # header, wrapped key, nonce and the sealed ballot with its tag, nothing else
+            self.assertEqual(envelope[:6], ENVELOPE_MAGIC)
+            size, = struct.unpack('>H', envelope[6:8])
+            self.assertEqual(len(envelope), 8 + size + 12 + len(serialized_ballot) + 16)
+            self.assertEqual(workflow.decrypt_serialized_ballot(envelope, private_pem_1), serialized_ballot)
+            # version 1 (Fernet) envelopes are still read
+            aes = HumanAES()
+            aes.generate()
+            wrapped_key = workflow.public_rsa.encrypt(aes.key)
+            legacy = (b'EVENV1' + struct.pack('>H', len(wrapped_key)) + wrapped_key +
+                      aes.encrypt(serialized_ballot.encode()))
+            self.assertEqual(workflow.decrypt_serialized_ballot(legacy, private_pem_1), serialized_ballot)
+
+    def test_mixed_encryption(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_election(folder, self.keys, 6, 3)
+            Workflow(folder, public_pem_1, private_pem_2, envelope=True).cast_vote('voter-4', ['Tim'])
+            workflow.decrypt_ballots(private_pem_1)
+            self.assertEqual(len(list(workflow.iter_preferences())), 4)
+
+    def test_archive_export(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            random.seed(6)
+            workflow = make_election(os.path.join(folder, 'election'), self.keys, 10, 7)
+            workflow.decrypt_ballots(private_pem_1)
+            results = workflow.count_votes(schulze)
+            # pack the election and recount without unpacking it
+            workflow.export(os.path.join(folder, 'packed'), packed=True)
+            self.assertEqual(sorted(os.listdir(os.path.join(folder, 'packed'))), [
+                'blank_ballots.pack', 'candidates.json', 'decrypted_ballots.pack', 'election.json',
+                'encrypted_ballots.pack', 'signatures.pack', 'voters.pack'])
+            storage = ArchiveStorage(os.path.join(folder, 'packed'))
+            observer = Workflow(os.path.join(folder, 'packed'), public_pem_1, None, storage=storage)
+            self.assertEqual(observer.count_votes(schulze), results)
+            report = observer.audit(public_pem_2, cache_path=os.path.join(folder, 'cache.json'))
+            self.assertEqual(report['errors'], [])
+            self.assertEqual((report['ballots'], report['encrypted'], report['voted']), (10, 7, 7))
+            # and unpack it
+            unpacked = os.path.join(folder, 'unpacked')
+            os.mkdir(unpacked)
+            observer.export(unpacked)
+            self.assertEqual(Workflow(unpacked, public_pem_1, None).count_votes(schulze), results)
+            for subfolder in ('encrypted_ballots', 'decrypted_ballots', 'signatures'):
+                self.assertEqual(sorted(os.listdir(os.path.join(unpacked, subfolder))),
+                                 sorted(os.listdir(os.path.join(folder, 'election', subfolder))))
+
+    def test_digest(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_election(folder, self.keys, 5, 4, digest='blake2b')
+            workflow.decrypt_ballots(private_pem_1)
+            # a new instance reads the digest from the manifest
+            observer = Workflow(folder, public_pem_1, None)
+            self.assertEqual(observer.digest, 'blake2b')
+            self.assertEqual(len(observer.hash('x')), 128)
+            self.assertEqual(observer.audit(public_pem_2)['errors'], [])
+            self.assertEqual(sum(n for n, _ in observer.count_votes(simple_majority)), 4)
+        with tempfile.TemporaryDirectory() as folder:
+            # elections without a manifest were hashed with md5
+            workflow = make_election(folder, self.keys, 5, 4)
+            workflow.decrypt_ballots(private_pem_1)
+            os.unlink(os.path.join(folder, 'election.json'))
+            observer = Workflow(folder, public_pem_1, None, digest='blake2b')
+            self.assertEqual(observer.digest, 'md5')
+            self.assertEqual(sum(n for n, _ in observer.count_votes(simple_majority)), 4)
+        with tempfile.TemporaryDirectory() as folder:
+            # nothing is created with an unusable digest
+            for digest in ('shake_128', 'not-a-digest'):
+                workflow = Workflow(folder, public_pem_1, private_pem_2, digest=digest)
+                self.assertRaises(ValueError, workflow.setup)
+                self.assertEqual(os.listdir(folder), [])
+
+    def test_live_tally(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_election(folder, self.keys, 12, 11, live=True)
+            live = workflow.live_tally
+            self.assertEqual(live.total, 11)
+            workflow.decrypt_ballots(private_pem_1)
+            self.assertEqual(live.simple_majority(), workflow.count_votes(simple_majority))
+            self.assertEqual(live.borda(), workflow.count_votes(borda))
+            self.assertTrue(workflow.check_live_tally())
+            # a vote that is not in the decrypted ballots
+            live.add(['Tim', 'John', 'Matt'])
+            self.assertFalse(workflow.check_live_tally())
+
+    def test_metrics(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        metrics = InMemoryMetrics()
+        with tempfile.TemporaryDirectory() as folder:
+            workflow = make_election(folder, self.keys, 5, 4, metrics=metrics)
+            with self.assertRaises(EVoteError):
+                workflow.cast_vote('voter-0', ['Tim', 'John', 'Matt'])
+            workflow.decrypt_ballots(private_pem_1)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {
+            'ballots_created': 5, 'votes_cast': 4, 'ballots_decrypted': 4})
+        for name in ('pick', 'encrypt', 'sign', 'decrypt'):
+            self.assertEqual(snapshot['timings'][name]['count'], 4)
+        # encrypted and decrypted ballots
+        self.assertEqual(snapshot['timings']['write']['count'], 8)
+        # voters (4 + 1 rejected) and the pool
+        self.assertEqual(snapshot['timings']['lock_wait']['count'], 9)
+        server = metrics.serve()
+        try:
+            url = 'http://%s:%i/metrics' % server.server_address
+            text = urllib.request.urlopen(url).read().decode()
+        finally:
+            server.shutdown()
+        self.assertIn('evote_votes_cast_total 4', text)
+        self.assertIn('evote_sign_seconds_count 4', text)
+        self.assertIn('evote_sign_seconds_bucket{le="+Inf"} 4', text)
+
+    def test_partial_tallies(self):
+        public_pem_1, private_pem_1, public_pem_2, private_pem_2 = self.keys
+        with tempfile.TemporaryDirectory() as folder:
+            workdir = os.path.join(folder, 'election')
+            workflow = make_election(workdir, self.keys, 12, 11)
+            workflow.decrypt_ballots(private_pem_1)
+            full = workflow.count_partial()
+            self.assertEqual(full.total, 11)
+            self.assertEqual(full.instant_runoff(), workflow.count_votes(instant_runoff))
+            self.assertEqual(full.borda(), workflow.count_votes(borda))
+            self.assertEqual(full.schulze(), workflow.count_votes(schulze))
+            # shards saved to files and merged in any order give the same tally
+            paths = []
+            for shard in range(3):
+                paths.append(os.path.join(folder, 'shard%i.json' % shard))
+                workflow.count_partial(shard, 3).save(paths[-1])
+            merged = PartialTally.load(paths[2]).merge(PartialTally.load(paths[0]))
+            self.assertEqual(merged.missing, [1])
+            merged.merge(PartialTally.load(paths[1]))
+            self.assertTrue(merged.complete)
+            self.assertEqual(merged, full)
+            self.assertEqual(merged.schulze(), full.schulze())
+            with self.assertRaises(ValueError):
+                merged.merge(PartialTally.load(paths[1]))
+            with self.assertRaises(ValueError):
+                workflow.count_partial(3, 3)
+            self.assertEqual(merged.profile, full.profile)
+            self.assertEqual(workflow.count_partial(workers=2, batch_size=4), full)
+            # and from the command line
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                main(['count', workdir, '--shard', '1/2', '--output', paths[0]])
+                main(['count', workdir, '--shard', '0/2', '--output', paths[1]])
+                main(['merge', paths[0], paths[1], '--algorithm', 'instant_runoff'])
+            results = json.loads(output.getvalue())
+            self.assertEqual(results['total'], 11)
+            # shards are numbered from 0 and all must be merged
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit):
+                    main(['count', workdir, '--shard', '2/2'])
+                with self.assertRaises(SystemExit):
+                    main(['merge', paths[0]])
+            self.assertEqual([tuple(item) for item in results['instant_runoff']], full.instant_runoff())